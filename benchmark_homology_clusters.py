@@ -0,0 +1,242 @@
+#! /usr/bin/python -u
+from string import *
+import sys, os, time, random, math, resource, hashlib
+sys.path.append('/home/mmariotti/scripts')
+from MMlib import *
+from homology_classes import *
+
+help_msg=""" Benchmark of the homology clustering of blast_homology_clusters.py on synthetic tabular blast files (m8).
+Files are generated (or reused, if already present in the -d folder) for each size, then each implementation is run in a separate process.
+Times are reported separately for each stage: parse, filter, cluster, output (-A format, written to /dev/null); also the peak memory (RSS) of each process.
+The -A output of each implementation is compared (md5) against the reference, which is the list-based algorithm used before the union-find engine.
+
+Usage: $  benchmark_homology_clusters.py  [options]
+
+## synthetic input
+-sizes  comma separated list of numbers of hits (lines) of the files to generate. Default: 1000000,10000000,50000000
+-sp     number of species
+-fd     family size distribution: geometric:MEAN  powerlaw:ALPHA  fixed:N
+-ch     chaining: probability that a hit links a protein to one of a different family, with an evalue still passing the threshold (these create large families)
+-no     noise: fraction of hits between random proteins with evalues not passing the threshold
+-seed   random seed
+-d      folder where synthetic files are written (and looked for, to reuse them). Default: temp folder
+
+## benchmark
+-e      blast evalue threshold, as in blast_homology_clusters.py
+-r      comma separated list of implementations to run, among: reference (list-based algorithm), engine (m8 line parser + union-find), numpy (columnar reader + union-find)
+-o      write results also to this tab separated file
+-filter filter expression, as in blast_homology_clusters.py -filter, applied by all implementations: line by line by engine (and reference), on blocks
+        by numpy, so that same_as_reference also checks that they agree. Synthetic files get two more columns, qlen and slen (as blast+ -outfmt
+        '6 std qlen slen'), which are 0 in 1% of lines to check divisions by zero
+
+### Options:
+-temp           temporary folder; a subfolder is created here and deleted upon exiting
+-print_opt      print currently active options
+-h OR --help    print this help and exit"""
+
+command_line_synonyms={}
+
+def_opt= {'temp':'/tmp',
+'sizes':'1000000,10000000,50000000', 'sp':10, 'fd':'geometric:8', 'ch':0.01, 'no':0.1, 'seed':1, 'd':0,
+'e':'1e-10', 'r':'reference,engine,numpy', 'o':0, 'filter':0,
+}
+
+#########################################################
+###### synthetic input
+
+def family_size_function(distribution):
+  """ Returns a function without arguments which draws a family size (>=2) according to distribution, a string like geometric:8, powerlaw:2.5, fixed:4 """
+  kind, value = distribution.split(':');  value=float(value)
+  if   kind=='geometric':  return lambda: 2 + int( random.expovariate( 1.0/max(value-2, 1e-6) ) )
+  elif kind=='powerlaw':   return lambda: 1 + int( random.paretovariate(value) )
+  elif kind=='fixed':      return lambda: max(2, int(value))
+  raise Exception, "ERROR invalid family size distribution: {0} ; see -help".format(distribution)
+
+def m8_line(query, subject, evalue, lengths=False):
+  bitscore=min(-math.log10(evalue)*3.3 + 30, 2000) if evalue>0 else 2000
+  line='{0}\t{1}\t{2:.2f}\t{3}\t{4}\t0\t1\t{3}\t1\t{3}\t{5:.2e}\t{6:.1f}'.format(query, subject, random.uniform(25, 100), random.randint(50, 600), random.randint(0, 80), evalue, bitscore)
+  if lengths:  line+='\t{0}\t{1}'.format( *[ 0 if random.random()<0.01 else random.randint(100, 1200) for i in range(2) ] )    # qlen, slen
+  return line+'\n'
+
+def generate_m8(filename, n_hits, n_species=10, family_sizes='geometric:8', chaining=0.01, noise=0.1, seed=1, good_evalue_range=(12, 180), bad_evalue_range=(0, 9), lengths=False):
+  """ Writes a synthetic tabular blast file with n_hits lines. Proteins (named like sp3.f125.7) are drawn in families with sizes following family_sizes;
+  hits within families have good evalues (10**-x, x in good_evalue_range); a fraction chaining of them link instead to a protein of a recent family;
+  a fraction noise of all hits are between random proteins, with bad evalues. Self hits are included, as in real all-against-all searches.
+  With lengths, lines have also qlen and slen columns """
+  random.seed(seed)
+  draw_size=family_size_function(family_sizes)
+  recent_proteins=[]      #proteins of recent families, targets for chaining
+  fh=open(filename, 'w');  n_written=0;  fam_index=0
+  while n_written < n_hits:
+    fam_index+=1
+    members=[ 'sp{0}.f{1}.{2}'.format(random.randrange(n_species), fam_index, i) for i in range(draw_size()) ]
+    n_family_hits=min( len(members)**2, 6*len(members) )
+    lines=[]
+    for hit_index in range(n_family_hits):
+      query=random.choice(members)
+      if   random.random() < noise and recent_proteins:     lines.append( m8_line(query, random.choice(recent_proteins), 10**-random.uniform(*bad_evalue_range), lengths) )
+      elif random.random() < chaining and recent_proteins:  lines.append( m8_line(query, random.choice(recent_proteins), 10**-random.uniform(good_evalue_range[0], good_evalue_range[0]+10), lengths) )
+      else:                                                 lines.append( m8_line(query, random.choice(members), 10**-random.uniform(*good_evalue_range), lengths) )
+    lines=lines[:n_hits-n_written]
+    fh.write( ''.join(lines) );   n_written+=len(lines)
+    recent_proteins.extend(members)
+    if len(recent_proteins)>10000: recent_proteins=recent_proteins[-5000:]
+  fh.close()
+
+#########################################################
+###### implementations and timing
+
+def reference_families(hits):
+  """ The list-based single link clustering used by blast_homology_clusters.py before the union-find engine, kept to check results and compare timings.
+  hits is an iterable of (subject, query) that passed the filters. Returns a list of families (lists of gene ids), largest first """
+  cluster_index2geneids={}; cluster_index=1
+  geneid2cluster_index={}
+  for id_left, id_right in hits:
+    if   (  not id_left in geneid2cluster_index )  and  ( not id_right in geneid2cluster_index ):  #new cluster
+      cluster_index2geneids [cluster_index] = [id_left, id_right]
+      geneid2cluster_index[id_left]=cluster_index;              geneid2cluster_index[id_right]=cluster_index
+      cluster_index+=1
+    elif (  id_left in geneid2cluster_index     )  and  ( not id_right in geneid2cluster_index ):
+      cluster_index2geneids [ geneid2cluster_index[id_left] ].append( id_right )
+      geneid2cluster_index[id_right]=   geneid2cluster_index[id_left]
+    elif ( not id_left in geneid2cluster_index  )  and  ( id_right in geneid2cluster_index ):
+      cluster_index2geneids [ geneid2cluster_index[id_right] ].append( id_left )
+      geneid2cluster_index[id_left]=    geneid2cluster_index[id_right]
+    elif geneid2cluster_index[id_left] != geneid2cluster_index[id_right]    :
+      if len( cluster_index2geneids [ geneid2cluster_index[id_right] ] )  > len( cluster_index2geneids [ geneid2cluster_index[id_left] ] ): id_left, id_right = id_right, id_left
+      cluster_index_to_remove = geneid2cluster_index[id_right]
+      for gid in cluster_index2geneids [ geneid2cluster_index[id_right] ]:
+        geneid2cluster_index[ gid ] =  geneid2cluster_index[id_left]
+      cluster_index2geneids[  geneid2cluster_index[id_left]  ].extend(   cluster_index2geneids[  cluster_index_to_remove  ]   )
+      del cluster_index2geneids[  cluster_index_to_remove  ]
+  ordered_cluster_indexes=sorted( cluster_index2geneids.keys(), key=lambda x:len(cluster_index2geneids[x]), reverse=True    )
+  return [ cluster_index2geneids[c] for c in ordered_cluster_indexes ]
+
+def output_families(families):
+  """ Writes families in -A format to /dev/null; returns the md5 of the output """
+  md5=hashlib.md5();  fh=open(os.devnull, 'w')
+  for fam_index, family in enumerate(families):
+    text=''.join( '{0}\tF{1}\n'.format(gid, fam_index+1) for gid in family )
+    fh.write(text);  md5.update(text)
+  fh.close()
+  return md5.hexdigest()
+
+def peak_rss_mb():  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0   #ru_maxrss is in Kb on linux
+
+def run_implementation(implementation, filename, evalue_threshold, filter_expression=None):
+  """ Runs an implementation on filename (with the -filter expression, if provided), timing each stage. Returns a dictionary with keys: parse, filter, cluster, output (seconds; None if not
+  separable for this implementation), n_hits, n_links, n_families, peak_rss (Mb), md5 (of -A output) """
+  result={'parse':None, 'filter':None}
+  extra_filter=compound_filter(filter_expression) if filter_expression else None
+  if implementation=='numpy':     # parsing and filtering are a single vectorized step
+    start=time.time()
+    edges=hit_edges()
+    for subject_indexes, query_indexes, evalues, bitscores in iterate_m8_blocks(filename, edges.ids, evalue_threshold, extra_filter=extra_filter):   edges.extend(subject_indexes, query_indexes, evalues)
+    result['parse']=time.time()-start
+  else:
+    start=time.time();  n_hits=0
+    for splt in iterate_m8_lines(filename): n_hits+=1
+    result['parse']=time.time()-start;   result['n_hits']=n_hits
+    start=time.time()
+    edges=hit_edges()
+    for id_left, id_right, evalue, bitscore in iterate_m8_hits(filename, evalue_threshold, extra_filter=extra_filter):  edges.add_hit(id_left, id_right, evalue, bitscore)
+    result['filter']=max(0.0, time.time()-start-result['parse'])
+  result['n_links']=len(edges)
+
+  if implementation=='reference':
+    ids=edges.ids
+    hits=[ (ids[i], ids[j]) for i, j in zip(edges.left, edges.right) ]
+    del edges
+    start=time.time()
+    families=reference_families(hits)
+  else:
+    start=time.time()
+    clusters=single_link_clustering(edges.ids)
+    clusters.add_links(edges.left, edges.right)
+    families=clusters.families()
+  result['cluster']=time.time()-start
+  start=time.time()
+  result['md5']=output_families(families)
+  result['output']=time.time()-start
+  result['n_families']=len(families)
+  result['peak_rss']=peak_rss_mb()
+  return result
+
+def run_in_child_process(function, *args):
+  """ Runs function(*args) in a forked process, so that its peak memory is measured in isolation. Returns its return value """
+  from multiprocessing import Process, Queue
+  queue=Queue()
+  def target():
+    try:               queue.put( (True, function(*args)) )
+    except Exception:  queue.put( (False, traceback_string()) )
+  process=Process(target=target);  process.start()
+  success, value = queue.get();    process.join()
+  if not success: raise Exception, "ERROR in benchmark child process:\n"+value
+  return value
+
+def traceback_string():
+  import traceback
+  return traceback.format_exc()
+
+#########################################################
+###### start main program function
+
+def main(args={}):
+#########################################################
+############ loading options
+  global opt
+  if not args: opt=command_line(def_opt, help_msg, '', synonyms=command_line_synonyms )
+  else:  opt=args
+  set_MMlib_var('opt', opt)
+  global temp_folder; temp_folder=Folder(random_folder(opt['temp'])); test_writeable_folder(temp_folder, 'temp_folder'); set_MMlib_var('temp_folder', temp_folder)
+
+  evalue_threshold=e_v(opt['e'])
+  implementations=str(opt['r']).split(',')
+  for implementation in implementations:
+    if not implementation in ['reference', 'engine', 'numpy']: raise Exception, "ERROR invalid implementation provided with option -r ! see -help"
+  data_folder=Folder(opt['d']) if opt['d'] else temp_folder
+
+  columns=['size', 'implementation', 'parse', 'filter', 'cluster', 'output', 'total', 'peak_rss', 'n_links', 'n_families', 'same_as_reference']
+  if opt['o']: out_fh=open(opt['o'], 'w');  print >> out_fh, join(columns, '\t')
+  write(join( ['{0:>14}'.format(c) for c in columns], ''), 1, how='reverse')
+  for size in [int(float(x)) for x in str(opt['sizes']).split(',')]:
+    filename=data_folder+'synthetic.{0}.sp{1}.{2}.ch{3}.no{4}.s{5}{6}.m8'.format(size, opt['sp'], replace(opt['fd'], ':', ''), opt['ch'], opt['no'], opt['seed'], '.len' if opt['filter'] else '')
+    if not is_file(filename):
+      write('Generating {0} ... '.format(filename))
+      start=time.time()
+      generate_m8(filename, size, n_species=opt['sp'], family_sizes=opt['fd'], chaining=opt['ch'], noise=opt['no'], seed=opt['seed'], lengths=bool(opt['filter']))
+      write('done ({0:.1f} s)'.format(time.time()-start), 1)
+
+    results={}
+    for implementation in implementations:
+      result=run_in_child_process(run_implementation, implementation, filename, evalue_threshold, opt['filter'] or None)
+      results[implementation]=result
+      result['total']=sum( result[k] for k in ['parse', 'filter', 'cluster', 'output'] if result[k] is not None )
+      result['same_as_reference']= '-' if not 'reference' in results else str(result['md5']==results['reference']['md5'])
+      values=[size, implementation]+[ '-' if result[k] is None else '{0:.2f}'.format(result[k]) for k in ['parse', 'filter', 'cluster', 'output', 'total', 'peak_rss'] ]+[result['n_links'], result['n_families'], result['same_as_reference']]
+      write(join( ['{0:>14}'.format(v) for v in values], ''), 1)
+      if opt['o']: print >> out_fh, join(map(str, values), '\t')
+    if data_folder==temp_folder: os.remove(filename)     #not reused
+  if opt['o']: out_fh.close()
+
+#######################################################################################################################################
+
+def close_program():
+  if 'temp_folder' in globals() and is_directory(temp_folder):
+    bbash('rm -r '+temp_folder)
+  try:
+    if get_MMlib_var('printed_rchar'):
+      printerr('\r'+printed_rchar*' ' ) #flushing service msg space
+  except:
+    pass
+
+  if 'log_file' in globals(): log_file.close()
+
+
+if __name__ == "__main__":
+  try:
+    main()
+    close_program()
+  except Exception:
+    close_program()
+    raise
@@ -7,41 +7,153 @@ sys.path.append('/home/mmariotti/scripts')
 #sys.path.append('/home/mmariotti/software/selenoprofiles')
 from MMlib import *
 #from annotate_with_tblastn import parse_blast_tab
-from selenoprofiles_3 import parse_blast, parse_blast_tab
+from selenoprofiles_3 import parse_blast_tab
+from homology_classes import *
 
 help_msg=""" Parse tabular output (m8) of blast and builds homology families. If two proteins have a blast hit satisfying the filter, they are joined in a family. Two proteins can be in the same family without having a blast hit linking them if there's a protein with blast hits to both (single link clustering). 
 Normal output is human readable (although may be very long). For usage with other programs (e.g. syntheny_view.py) see option -A
 
 Usage: $  blast_homology_clusters.py  blast_output.tab  [options]  > output
+Input files (blast output and -add fasta) can be compressed with gzip, bz2 or xz; they are decompressed on the fly in a background thread.
 
 -e      blast evalue
--b      blast output is default blastall, not tabular
+-b      blast output is default blastall (pairwise), not tabular. It is read with a streaming parser which looks only at query, subject and score lines
+-cpu    use N processes to parse and filter the (tabular) input, which is split in chunks
+-np     use the columnar numpy reader for the (tabular) input: faster and lighter in memory
+-cache  keep hits passing -e and -filter in a binary cache file (default: input file + .bhc; or provide a path), reused automatically by later runs on the
+        same unchanged input with same -b, -filter and a -e not looser: they skip parsing (changing -s, -n, -m, output etc. is fine). Not with -mem, -reduce
 
 -n      require at least N members in a cluster to output a family
 -m      in normal output (no -A) defined max examples shown for cluster
 
 -A      tab output in families, as for the adhore program. Example of a line:   protein1-tab-F1
+-AI     write also a binary gene-to-family index to this file, with the same content as -A output. It can be used instead of the -A output in syntheny_view.py -f, for fast start-up
 -add    provide fasta file to add proteins with no hits as single member families (if -A is active) or for stats in normal output
+        A title index is built next to it (file.tidx) and reused in later runs, so sequences are never loaded
 
 -s      do not count links involving same species
--sf     species function, in lambda style. Every protein name is evaluated in this way to extract species name 
+-sf     species function, in lambda style. Every protein name is evaluated in this way to extract species name (only once per protein)
+-filter additional filter on hit columns, as python expression (quote it). Names: pident length mismatch gapopen qstart qend sstart send evalue bitscore,
+        qlen slen (13th and 14th columns, as in blast+ -outfmt '6 std qlen slen'), qcov scov (query and subject coverage in percent; require qlen slen)
+        e.g.   -filter "bitscore>=50 and pident>=30 and qcov>=50 and scov>=50"     With -np, it is applied to whole blocks of lines at once. Not with -b
+
+## hit pruning
+-top    keep only the hits of each query with its best N subjects (after the filters above). Repetitive domains produce many redundant hits:
+        pruning them reduces clustering time and memory. Not compatible with -cpu, -np, -reduce. With -map, queries are pruned within each shard
+-top_by rank subjects by evalue (default) or bitscore
+-recip  with -top, keep a hit only if also the query is among the best N subjects of the subject
+
+## hubs
+-hub    degree cutoff for hubs: promiscuous proteins (e.g. with common domains) whose hits chain unrelated families into giant ones. The degree of a
+        protein is the number of distinct proteins it has hits with (after the filters above). Provide a max degree (e.g. 200) or a percentile of the
+        degree distribution (e.g. 99.9%). Hits of hubs are dropped before clustering, so hubs do not appear in families. Requires numpy.
+        Not compatible with -cpu, -np, -mem, -reduce (hits are kept in memory until all are read, ~24 bytes each)
+-hubo   write a report of hubs to this file: one line per hub with its degree and the components it bridges (the clusters of its neighbours)
+-hubk   keep the hits of hubs in clustering: only detect and report them
+
+## clustering algorithm
+-alg    one of: sl (single link clustering, default), cc (connected components of a sparse matrix, same families as sl), mcl (markov clustering on a sparse matrix)
+        cc and mcl require numpy and scipy, and are not compatible with -cpu, -save and -load
+-w      with -alg mcl, weight used for hits: evalue (meaning -log10 of it) or bitscore
+-I      with -alg mcl, inflation value. Higher values produce smaller families
+
+## evalue threshold sweep
+-sweep  comma separated list of evalue thresholds (e.g. 1e-5,1e-10,1e-20). The input is parsed only once, and families are computed for each threshold
+        and written in -A format to a separate file (see -swo). Not compatible with -cpu, -save, -load, -alg, -mem
+-swo    prefix for output files of -sweep; the threshold and .tab are added to it. Default: families.e   (e.g. families.e1e-10.tab)
+
+## incremental clustering
+-save   save the clustering state to this binary file at the end of the run
+-load   load a clustering state file saved with -save, and add to it the hits in the input file (e.g. those of a new genome). Output is produced for the merged state
+
+## sharded clustering (map/reduce)
+-map    map step: cluster the input (e.g. one of many blast output shards) and write its clusters to this partial component file, instead of normal output
+-reduce reduce step: the input is not blast output, but a partial component file written with -map, or a text file listing such files (one per line).
+        They are merged into the final families, which are output as usual (or with -map, written to a new partial component file, to reduce hierarchically).
+        Options -e, -s, -sf, -filter are taken from the partial files, which must all have been built with the same ones. Not compatible with -b, -cpu, -np
+        Families are the same as processing all shards together; the order of members, and of families of the same size, may differ
+
+## out-of-core clustering
+-mem    memory budget, e.g. 8G or 500M. Gene ids and clustering arrays are kept in files of the temp folder (memory-mapped), and hits are processed in passes
+        so that memory use stays around this value. For inputs with more distinct ids than what fits in memory. Requires numpy, and some disk space
+        (16 bytes per hit, plus ~40 bytes per id). Same families as normal runs, but families of the same size may be numbered in a different order.
+        Only with -alg sl; not compatible with -cpu, -np, -save, -load, -sweep, -AI
+
+## monitoring
+-stats  write statistics of the run to this file, in json format: time spent in each stage (parse, filter, merge, sort, output...), hits read per second,
+        hits rejected by each filter (evalue, self hits, same species, -filter), merge operations and members moved, largest cluster over time, peak memory.
+        Progress is also reported on stderr. With line-based readers, the time of filters is included in parse; -np times them separately
 
 ### Options:
+-temp           temporary folder; a subfolder is created here (only when needed) and deleted upon exiting
 -print_opt      print currently active options
 -h OR --help    print this help and exit"""
 
 command_line_synonyms={}
 
-def_opt= {#'temp':'/users/rg/mmariotti/temp', 
+def_opt= {'temp':'/tmp', 
 'i':0, 
 'e':'1e-10', 'b':0, 
 'A':0, 'add':0, 
 'm':5, 
   's':1, 'sf': "x.split('.')[0]",
 'v':0, 'n':0,
+'cpu':1, 'np':0,
+'save':0, 'load':0,
+'alg':'sl', 'w':'evalue', 'I':2.0,
+'sweep':0, 'swo':'families.e',
+'AI':0,
+'stats':0,
+'mem':0,
+'map':0, 'reduce':0,
+'top':0, 'top_by':'evalue', 'recip':0,
+'filter':0,
+'cache':0,
+'hub':0, 'hubo':0, 'hubk':0,
 }
 
 
+def filter_blast_hits(parser_handler, evalue_threshold, species_function=None, stats=None):
+  """ Generator of the hits passing the filters, yielded as tuples (subject, query, evalue, bitscore). See filter_hits in homology_classes.py for the filters
+  and for stats. Bitscores are not read from the hit objects, so they are always 0.0 """
+  return filter_hits( ( (bhit.chromosome, bhit.query.chromosome, bhit.evalue, 0.0) for bhit in parser_handler ), evalue_threshold, species_function, stats )
+
+def build_hits_cache(input_file, cache_file, cache_key, evalue_threshold, extra_filter=None, stats=None):
+  """ Parses the input keeping the hits which pass -e and -filter (but not -s: species are checked when reading the cache) in a hit_edges, which is saved as
+  hits cache in cache_file (with a warning if not possible) and returned """
+  edges=hit_edges()
+  if stats: stats.start('parse')
+  if opt['np']:
+    for subject_indexes, query_indexes, evalues, bitscores in iterate_m8_blocks(input_file, edges.ids, evalue_threshold, None, with_bitscores=True, stats=stats, extra_filter=extra_filter):
+      edges.extend(subject_indexes, query_indexes, evalues, bitscores)
+  else:
+    if not opt['b']:  hit_handler=iterate_m8_hits(input_file, evalue_threshold, None, stats=stats, extra_filter=extra_filter)
+    else:             hit_handler=iterate_pairwise_hits(input_file, evalue_threshold, None, stats=stats)
+    for id_left, id_right, evalue, bitscore in hit_handler:    edges.add_hit(id_left, id_right, evalue, bitscore)
+  if stats:
+    stats.counts['passed']-=len(edges)    #counted again when read from cache
+    stats.stop();   stats.start('save')
+  try:                       edges.save(cache_file, dict(cache_key, e=evalue_threshold))
+  except (IOError, OSError): printerr('WARNING could not write the hits cache file: {0}'.format(cache_file), 1)
+  if stats: stats.stop()
+  return edges
+
+def report_progress(stats, clusters=None):
+  """ Records a snapshot of the run in stats (see run_stats in homology_classes.py) and shows it as service message """
+  stats.snapshot(clusters)
+  service(stats.progress_line())
+
+def get_temp_folder():
+  """ Returns the temp folder of this run, which is created only the first time this is called (and deleted by close_program) """
+  global temp_folder
+  if not 'temp_folder' in globals(): temp_folder=Folder(random_folder(opt['temp'])); test_writeable_folder(temp_folder, 'temp_folder'); set_MMlib_var('temp_folder', temp_folder)
+  return temp_folder
+
+def uncompressed_path(filename, label):
+  """ MMlib parsers accept only file paths: if filename is compressed, it is decompressed on the fly into a named pipe in the temp folder, whose path is returned """
+  if not compression_format(filename): return filename
+  return decompress_to_fifo(filename, get_temp_folder()+label+'.fifo')
+
 #########################################################
 ###### start main program function
 
@@ -57,73 +169,171 @@ def main(args={}):
   #checking input
   input_file=opt['i'];   check_file_presence(input_file, 'input_file')
   all_titles_short2long= {} 
-  if opt['add']: all_titles_short2long=   dict( (t.split()[0], t)  for t,s in parse_fasta(opt['add']) )
+  if opt['add']: all_titles_short2long=   load_fasta_titles(opt['add'])   #titles are read lazily, through an index file reused in later runs
   max_examples=opt['m']
   evalue_threshold=e_v(opt['e'])
+  if opt['sweep']:
+    sweep_threshold2string=dict( (e_v(x), x) for x in str(opt['sweep']).split(',') )
+    evalue_threshold=max(sweep_threshold2string)       #parsing with the loosest threshold
   species_function= eval('lambda x:'+opt['sf'])
+  if not opt['mem']: species_function=cached_function(species_function)   #species computed once per id (with -mem, not keeping them in memory)
+  extra_filter=None
+  if opt['filter']:
+    if opt['b']: raise Exception, "ERROR option -filter is not available with -b"
+    extra_filter=compound_filter(str(opt['filter']))
+  stats=None
+  if opt['stats']:
+    stats=run_stats()
+    stats.info['input']=input_file
+    stats.info['options']=dict( (k, opt[k]) for k in ['e', 'b', 's', 'sf', 'n', 'cpu', 'np', 'alg', 'sweep', 'load'] )
+
+  state_options= dict( (k, opt[k]) for k in ['e', 's', 'sf'] )   #options that must be the same for all runs adding to the same clustering state
+  if opt['filter']: state_options['filter']=opt['filter']
+  if opt['reduce']:
+    if opt['b'] or opt['cpu']>1 or opt['np'] or opt['filter']: raise Exception, "ERROR option -reduce is not compatible with -b, -cpu, -np, -filter"
+    if is_partial_components(input_file): partial_files=[input_file]
+    else:
+      partial_files=[line.strip() for line in open(input_file) if line.strip() and not line.startswith('#')]
+      for partial_file in partial_files:
+        check_file_presence(partial_file, 'partial component file')
+        if not is_partial_components(partial_file): raise Exception, "ERROR {0} is not a partial component file! (listed in {1})".format(partial_file, input_file)
+    state_options=partial_components_options(partial_files)
+  if opt['np'] and (opt['b'] or opt['cpu']>1): raise Exception, "ERROR option -np is available only for tabular blast output (no -b), and not with -cpu"
+  if opt['map'] and (opt['AI'] or opt['sweep']): raise Exception, "ERROR option -map is not compatible with -AI, -sweep"
+  if opt['top']:
+    if opt['cpu']>1 or opt['np'] or opt['reduce']:  raise Exception, "ERROR option -top is not compatible with -cpu, -np, -reduce"
+    if not opt['top_by'] in ['evalue', 'bitscore']: raise Exception, "ERROR invalid value for option -top_by: {0} ; use evalue or bitscore".format(opt['top_by'])
+  elif opt['recip']:   raise Exception, "ERROR option -recip requires option -top"
+  hubs=None
+  if opt['hub']:
+    if opt['cpu']>1 or opt['np'] or opt['mem'] or opt['reduce']:  raise Exception, "ERROR option -hub is not compatible with -cpu, -np, -mem, -reduce"
+    try:                hubs=hub_detector(opt['hub'], drop=not opt['hubk'])
+    except ValueError:  raise Exception, "ERROR invalid degree cutoff provided with option -hub: {0} ; use something like 200 or 99.9%".format(opt['hub'])
+  elif opt['hubo'] or opt['hubk']:  raise Exception, "ERROR options -hubo and -hubk require option -hub"
+  if not opt['alg'] in ['sl', 'cc', 'mcl']: raise Exception, "ERROR invalid algorithm provided with option -alg ! see -help"
+  sparse_backend= opt['alg']!='sl'
+  collect_edges= sparse_backend or opt['sweep']
+  if opt['sweep'] and (sparse_backend or opt['cpu']>1 or opt['load'] or opt['save'] or opt['mem'] or opt['reduce']): raise Exception, "ERROR option -sweep is not compatible with -cpu, -save, -load, -alg, -mem, -reduce"
+  if collect_edges:    #collecting all hits, then clustering
+    if opt['cpu']>1 or opt['load'] or opt['save'] or opt['mem'] or opt['map'] or opt['reduce']: raise Exception, "ERROR options -cpu, -load, -save, -mem, -map and -reduce are available only with single link clustering (-alg sl)"
+    edges=hit_edges()
+  elif opt['mem']:
+    if opt['cpu']>1 or opt['np'] or opt['load'] or opt['save'] or opt['AI']: raise Exception, "ERROR option -mem is not compatible with -cpu, -np, -save, -load, -AI"
+    try:                memory_budget=parse_memory_size(opt['mem'])
+    except ValueError:  raise Exception, "ERROR invalid memory size provided with option -mem: {0} ; use something like 8G or 500M".format(opt['mem'])
+  elif opt['load']:
+    check_file_presence(opt['load'], '-load file')
+    if stats: stats.start('load')
+    clusters, loaded_options = load_clustering(opt['load'])
+    if stats: stats.stop()
+    for k in set(state_options) | set(loaded_options):
+      if loaded_options.get(k) != state_options.get(k): raise Exception, "ERROR the clustering state file {0} was built with -{1} {2} ; this run must use the same value (now: {3})".format(opt['load'], k, loaded_options.get(k), state_options.get(k))
+  else: clusters=single_link_clustering(history=bool(opt['save']))     # with history, tied families keep their order after -load
 
-  cluster_index2geneids={}; cluster_index=1
-  geneid2cluster_index={}
-  parser_handler=parse_blast_tab(input_file)    if not opt['b'] else   parse_blast(input_file)
-
-  for bhit in parser_handler:
-    if not  bhit.evalue < evalue_threshold: continue
-
-    id_left, id_right=     bhit.chromosome, bhit.query.chromosome
-    if opt['s']:           species_left, species_right=  species_function( id_left ) , species_function( id_right )
-#    species_left, species_right=  id_left.split('.')[0], id_right.split('.')[0]
-    if   id_left != id_right    and (not opt['s'] or species_left != species_right):
-      if   (  not id_left in geneid2cluster_index )  and  ( not id_right in geneid2cluster_index ):  #new cluster
-        cluster_index2geneids [cluster_index] = [id_left, id_right]
-        geneid2cluster_index[id_left]=cluster_index;              geneid2cluster_index[id_right]=cluster_index
-        cluster_index+=1
-#        print '1 creating with ids: ',id_left, id_right, ' the cluster ', cluster_index-1
-      elif (  id_left in geneid2cluster_index     )  and  ( not id_right in geneid2cluster_index ):
-        cluster_index2geneids [ geneid2cluster_index[id_left] ].append( id_right )
-        geneid2cluster_index[id_right]=   geneid2cluster_index[id_left]
-#        print '2 moving id: '+id_right+' to cluster ', cluster_index
-      elif ( not id_left in geneid2cluster_index  )  and  ( id_right in geneid2cluster_index ):
-        cluster_index2geneids [ geneid2cluster_index[id_right] ].append( id_left )
-        geneid2cluster_index[id_left]=    geneid2cluster_index[id_right]
-#        print '3 moving id: '+id_left+' to cluster ', cluster_index
-      elif geneid2cluster_index[id_left] != geneid2cluster_index[id_right]    : #not id_left in geneid2cluster_index  and  not id_right in geneid2cluster_index   is implicit
-        #putting those in cluster of id_right into the cluster in id_left, unless the reverse is more efficient
-        if len( cluster_index2geneids [ geneid2cluster_index[id_right] ] )  > len( cluster_index2geneids [ geneid2cluster_index[id_left] ] ): id_left, id_right = id_right, id_left
-#        print '4 LEFT:', id_left,  'c:', geneid2cluster_index[id_left],  'RIGHT:',  id_right, 'c:', geneid2cluster_index[id_right]
-
-        cluster_index_to_remove = geneid2cluster_index[id_right]
-        for gid in cluster_index2geneids [ geneid2cluster_index[id_right] ]:
-#          print '4 moving id: '+gid, 'from cluster', cluster_index_to_remove, ' to cluster ', geneid2cluster_index[id_left]
-          geneid2cluster_index[ gid ] =  geneid2cluster_index[id_left]
-        cluster_index2geneids[  geneid2cluster_index[id_left]  ].extend(   cluster_index2geneids[  cluster_index_to_remove  ]   )
-#        print '4 removing cluster', cluster_index_to_remove
-        del cluster_index2geneids[  cluster_index_to_remove  ]
-
-
-  ordered_cluster_indexes=sorted( cluster_index2geneids.keys(), key=lambda x:len(cluster_index2geneids[x]), reverse=True    )  #largest clusters first
-
-  if opt['n']:   
-    for fam_index,  cluster_index in enumerate(ordered_cluster_indexes[::-1]):
-      if len(cluster_index2geneids[cluster_index]) < opt['n']: 
-        del cluster_index2geneids[cluster_index]
-        ordered_cluster_indexes.pop( -1 )
+  cached_hits=None
+  if opt['cache']:
+    if opt['mem'] or opt['reduce']: raise Exception, "ERROR option -cache is not compatible with -mem, -reduce"
+    cache_file= input_file+'.bhc' if opt['cache']==1 else opt['cache']
+    cache_key= hits_cache_key(input_file, b=bool(opt['b']), filter=opt['filter'] or None)
+    if hits_cache_matches(cache_file, cache_key, evalue_threshold):
+      if stats: stats.start('load')
+      cached_edges=load_hit_edges(cache_file)[0]
+      if stats: stats.stop();   stats.info['hits_cache']='reused'
+    else:
+      cached_edges=build_hits_cache(input_file, cache_file, cache_key, evalue_threshold, extra_filter, stats)
+      if stats: stats.info['hits_cache']='built'
+    cached_hits=iterate_edges_hits(cached_edges, evalue_threshold, species_function if opt['s'] else None, stats=stats)
+
+  if opt['np'] and cached_hits is None:
+    ids=edges.ids if collect_edges else clusters.ids
+    blocks=iterate_m8_blocks(input_file, ids, evalue_threshold, species_function if opt['s'] else None, with_bitscores=sparse_backend and opt['w']=='bitscore', stats=stats, extra_filter=extra_filter)
+    batches=[blocks] if stats is None else stats.timed_batches(blocks, 'parse', batch_size=1)
+    for batch in batches:
+      if stats: stats.start('collect' if collect_edges else 'merge')
+      for subject_indexes, query_indexes, evalues, bitscores in batch:
+        if collect_edges:   edges.extend(subject_indexes, query_indexes, evalues, bitscores)
+        else:               clusters.add_links(subject_indexes.tolist(), query_indexes.tolist())
+      if stats: stats.stop();   report_progress(stats, None if collect_edges else clusters)
+  else:
+    if cached_hits is not None: hit_handler=cached_hits
+    elif opt['reduce']:  hit_handler=partial_component_hits(partial_files)
+    elif opt['cpu']>1:
+      if opt['b']: raise Exception, "ERROR option -cpu is available only for tabular blast output (no -b)"
+      hit_handler=parallel_m8_hits(input_file, opt['cpu'], evalue_threshold, opt['sf'] if opt['s'] else None, stats=stats, filter_expression=extra_filter and extra_filter.expression)
+    elif opt['b']:    hit_handler=iterate_pairwise_hits(input_file, evalue_threshold, species_function if opt['s'] else None, stats=stats)
+    elif collect_edges or opt['mem'] or opt['top'] or extra_filter:
+      hit_handler=iterate_m8_hits(input_file, evalue_threshold, species_function if opt['s'] else None, stats=stats, extra_filter=extra_filter)  #bitscores or other columns are needed, or no hit objects wanted
+    else:
+      parser_handler=parse_blast_tab( uncompressed_path(input_file, 'input') )
+      hit_handler=filter_blast_hits(parser_handler, evalue_threshold, species_function if opt['s'] else None, stats=stats)
+    if opt['top']:  hit_handler=top_hits_per_query(hit_handler, opt['top'], opt['top_by'], opt['recip'], stats)
+    if hubs:        hit_handler=hubs.filter(hit_handler, stats)
+    if opt['mem']:
+      clusters=external_single_link_clustering(hit_handler, get_temp_folder(), memory_budget, stats)   #two passes on disk, see homology_classes.py
+      batches=[]
+    elif stats is None: batches=[hit_handler]
+    else:               batches=stats.timed_batches(hit_handler, 'parse')   #with stats, hits are read in batches to time separately parsing and clustering
+    for batch in batches:
+      if stats: stats.start('collect' if collect_edges else 'merge')
+      if collect_edges:
+        for id_left, id_right, evalue, bitscore in batch:    edges.add_hit(id_left, id_right, evalue, bitscore)
+      else:
+        for id_left, id_right, evalue, bitscore in batch:    clusters.add_hit(id_left, id_right)
+      if stats: stats.stop();   report_progress(stats, None if collect_edges else clusters)
+
+  if hubs:
+    printerr('-hub {0} hubs found (degree > {1}); {2} hits dropped'.format(len(hubs.hubs), hubs.max_degree, hubs.n_dropped), 1)
+    if opt['hubo']:
+      if stats: stats.start('hubs')
+      hubs.write_report(opt['hubo'])
+      if stats: stats.stop()
+
+  if opt['sweep']:
+    if stats: stats.start('sweep')
+    for threshold, families in sweep_families(edges, sweep_threshold2string.keys(), min_size=opt['n']):
+      output_file=opt['swo']+sweep_threshold2string[threshold]+'.tab'
+      fh=open(output_file, 'w')
+      for fam_index, family in enumerate(families):
+        for gid in family:    print >> fh, '{0}\tF{1}'.format(gid, fam_index+1)
+      fh.close()
+      write('-sweep evalue < {0:<10} : {1:>8} families --> {2}'.format(sweep_threshold2string[threshold], len(families), output_file), 1)
+    if stats: stats.stop();  stats.write_json(opt['stats'])
+    return
+  if sparse_backend:
+    if stats: stats.start('cluster')
+    families=sparse_families(edges, opt['alg'], opt['w'], opt['I'], min_size=opt['n'])  #largest clusters first
+    if stats: stats.stop()
+  else:
+    if opt['save']:
+      if stats: stats.start('save')
+      clusters.save(opt['save'], state_options)
+      if stats: stats.stop()
+    if stats: stats.start('sort')
+    families=clusters.families(min_size=0 if opt['map'] else opt['n'])  #largest clusters first. With -map, small ones may grow in the reduce step
+    if stats: stats.stop()
 
   ###### now it's time to output
-  if opt['A']:
-    for fam_index, cluster_index in enumerate(ordered_cluster_indexes):
-      #printerr('', 1)
-      for gid in cluster_index2geneids[cluster_index]:
+  if stats: stats.start('output')
+  if opt['AI']:  write_family_index(opt['AI'], families)
+  if opt['map']:  write_partial_components(opt['map'], families, state_options)   #no other output in the map step
+  elif opt['A']:
+    for fam_index, family in enumerate(families):
+      for gid in family:
         write('{0}\tF{1}'.format(gid, fam_index+1), 1)
   else:
-    write('N clusters: {0}'.format(len(cluster_index2geneids.keys())), 1)
-    for fam_index, cluster_index in enumerate(ordered_cluster_indexes):
-      write('Cluster F{1} has {0:^5} elements:'.format(len( cluster_index2geneids[cluster_index]), fam_index+1), 1, how='red')
-      for short_t in cluster_index2geneids[cluster_index]  [:max_examples]:
+    write('N clusters: {0}'.format(len(families)), 1)
+    for fam_index, family in enumerate(families):
+      write('Cluster F{1} has {0:^5} elements:'.format(len(family), fam_index+1), 1, how='red')
+      for short_t in family[:max_examples]:
         long_t=''
         if opt['add']: 
           try:    long_t= all_titles_short2long[short_t].split('#')[1] [:100]
           except: pass
         write(' '+short_t+' '+long_t , 1)
+  if stats:
+    stats.stop()
+    stats.info['families']=len(families)
+    stats.write_json(opt['stats'], None if sparse_backend else clusters)
 
 
 #######################################################################################################################################
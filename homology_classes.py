@@ -0,0 +1,1395 @@
+#! /usr/bin/python -u
+""" Classes and functions used by blast_homology_clusters.py (and readers of its output) to build homology families out of blast hits. Nothing here depends on MMlib, so it can be imported from any script """
+from array import array
+import struct, json, os, threading, Queue, zlib, bz2, mmap, time, resource, ctypes, heapq, ast, operator, re
+from itertools import izip, islice
+try:                 import lzma
+except ImportError:
+  try:                 from backports import lzma
+  except ImportError:  lzma=None
+try:                 import numpy
+except ImportError:  numpy=None
+try:                 from scipy import sparse
+except ImportError:  sparse=None
+
+class id_table(object):
+  """ Interning table for gene ids: each distinct string gets a dense integer index (0, 1, 2 ...) in order of first appearance.
+  Usage:   t=id_table();  i=t.index('protein1');   t[i] --> 'protein1' """
+  def __init__(self):
+    self.id2index={}
+    self.index2id=[]
+  def __len__(self):             return len(self.index2id)
+  def __getitem__(self, index):  return self.index2id[index]
+  def __contains__(self, gid):   return gid in self.id2index
+  def index(self, gid):
+    """ Returns the integer index of gid, adding it to the table if never seen before """
+    index=self.id2index.setdefault(gid, len(self.index2id))
+    if index==len(self.index2id): self.index2id.append(gid)
+    return index
+
+class single_link_clustering(object):
+  """ Single link clustering engine working on dense integer ids (see id_table). It is an array-backed union-find (union by size, path compression);
+  each set also keeps a linked list of its members, so that families can be materialized only once at the end, with members in the same order
+  in which the historical list-based algorithm of blast_homology_clusters.py would have produced them.
+  Usage:   c=single_link_clustering();   c.add_hit('protein1', 'protein2');  ... ;   families=c.families()
+  Arrays (one slot per id in self.ids):
+    parent        -1 if the id was never linked, otherwise its parent in the union-find forest (itself if root)
+    size          number of members, for roots
+    next_member   next id in the member list of its set (-1 at the end)
+    tail          last member of the list, for roots
+    root2cluster_index   the cluster index (1-based, in order of creation) associated to each root
+  Counters, for instrumentation: self.n_merges (merges of two existing clusters), self.n_moved (members of the smaller cluster in those merges, i.e.
+  those relabelled by the list-based algorithm), self.largest (size of the largest cluster so far)
+  self.cluster_index2root keeps the clusters currently alive. It is a dictionary on purpose: it receives the same insertions and deletions as the
+  cluster_index2geneids dictionary of the original algorithm, so that iterating it gives the same order (relevant for ties in family size).
+  With history=True, these insertions and deletions are also recorded in self.history (cluster index, negative if deleted): save stores them, so that
+  load_clustering can replay them and the dictionary iterates in the same order as in an uninterrupted run """
+  def __init__(self, ids=None, history=False):
+    if ids is None: ids=id_table()
+    self.ids=ids
+    self.history=array('i') if history else None
+    self.parent=array('i');   self.size=array('i');   self.next_member=array('i');   self.tail=array('i');   self.root2cluster_index=array('i')
+    self.cluster_index2root={}
+    self.cluster_index=1
+    self.n_merges=0;  self.n_moved=0;  self.largest=0
+
+  def reserve(self, n):
+    """ Makes sure that the arrays have a slot for at least n ids. They are grown geometrically, so that adding ids one by one is cheap """
+    missing=n-len(self.parent)
+    if missing>0:
+      missing=max(missing, len(self.parent), 1024)
+      filler=array('i', [-1])*missing
+      for a in (self.parent, self.size, self.next_member, self.tail, self.root2cluster_index): a.extend(filler)
+
+  def find(self, index):
+    """ Returns the root of the set of index (which must have been linked already), compressing the path on the way """
+    parent=self.parent
+    root=index
+    while parent[root]!=root: root=parent[root]
+    while parent[index]!=root:  parent[index], index = root, parent[index]
+    return root
+
+  def is_linked(self, index):    return index<len(self.parent) and self.parent[index]>=0
+
+  def _append_member(self, root, index):
+    self.parent[index]=root
+    self.next_member[ self.tail[root] ]=index;    self.tail[root]=index
+    self.size[root]+=1
+    if self.size[root]>self.largest: self.largest=self.size[root]
+
+  def add_link(self, index_left, index_right):
+    """ Joins the sets of two integer ids. Returns True if this changed the clustering (new cluster, new member or merge), False if they were already together """
+    if index_left==index_right: return False
+    parent=self.parent
+    if index_left>=len(parent) or index_right>=len(parent): self.reserve( max(index_left, index_right)+1 )
+    parent_left, parent_right = parent[index_left], parent[index_right]
+    if parent_left<0:
+      if parent_right<0:     #new cluster
+        parent[index_left]=index_left;   parent[index_right]=index_left
+        self.next_member[index_left]=index_right;   self.tail[index_left]=index_right;  self.size[index_left]=2
+        self.root2cluster_index[index_left]=self.cluster_index;     self.cluster_index2root[self.cluster_index]=index_left
+        if not self.history is None: self.history.append(self.cluster_index)
+        self.cluster_index+=1
+        if self.largest<2: self.largest=2
+      else:   self._append_member( parent_right if parent[parent_right]==parent_right else self.find(index_right), index_left )
+    elif parent_right<0:    self._append_member( parent_left if parent[parent_left]==parent_left else self.find(index_left), index_right )
+    else:
+      root_left=  parent_left  if parent[parent_left]==parent_left   else self.find(index_left)
+      root_right= parent_right if parent[parent_right]==parent_right else self.find(index_right)
+      if root_left==root_right: return False
+      #putting those in cluster of right into the cluster of left, unless the reverse is more efficient
+      size=self.size
+      if size[root_right] > size[root_left]: root_left, root_right = root_right, root_left
+      self.next_member[ self.tail[root_left] ]=root_right;    self.tail[root_left]=self.tail[root_right]
+      size[root_left]+=size[root_right]
+      parent[root_right]=root_left
+      self.n_merges+=1;   self.n_moved+=size[root_right]
+      if size[root_left]>self.largest: self.largest=size[root_left]
+      del self.cluster_index2root[ self.root2cluster_index[root_right] ]
+      if not self.history is None: self.history.append( -self.root2cluster_index[root_right] )
+    return True
+
+  def add_links(self, left_indexes, right_indexes):
+    """ Same as add_link for many links at once (two sequences of integer ids, e.g. arrays), in order. Faster, since links between ids
+    already sharing the same parent (the most common case for redundant hits, thanks to path compression) are skipped without any function call """
+    if not len(left_indexes): return
+    self.reserve( max( max(left_indexes), max(right_indexes) )+1 )
+    parent=self.parent;  add_link=self.add_link
+    for index_left, index_right in izip(left_indexes, right_indexes):
+      parent_left=parent[index_left]
+      if parent_left>=0 and parent_left==parent[index_right]: continue
+      add_link(index_left, index_right)
+
+  def add_hit(self, id_left, id_right):
+    """ Same as add_link, but accepting gene ids (strings) """
+    return self.add_link( self.ids.index(id_left), self.ids.index(id_right) )
+
+  def n_clusters(self):  return len(self.cluster_index2root)
+
+  def member_indexes(self, root):
+    """ Returns the list of integer ids in the set of this root, in order of addition """
+    out=[];  next_member=self.next_member
+    while root!=-1:
+      out.append(root);    root=next_member[root]
+    return out
+
+  def ordered_roots(self, min_size=0):
+    """ Returns the roots of all clusters, largest first. Clusters with less than min_size members are omitted """
+    size=self.size
+    roots=sorted( self.cluster_index2root.values(), key=lambda r:size[r], reverse=True )   #values order follows keys order
+    if min_size: roots=[r for r in roots if size[r]>=min_size]
+    return roots
+
+  def families(self, min_size=0):
+    """ Returns a list of families, each one a list of gene ids. Largest families first; those with less than min_size members are omitted """
+    ids=self.ids
+    return [ [ids[i] for i in self.member_indexes(root)] for root in self.ordered_roots(min_size) ]
+
+  state_file_magic='BHC_STATE_2\n'
+  def save(self, filename, options={}):
+    """ Saves the clustering state in a compact binary file, which can be loaded with load_clustering to add more hits later.
+    options is a dictionary (json serializable) with the run options, stored as well to check that later runs are compatible.
+    Without history (see __init__), only the current clusters are stored, so families of the same size may be ordered differently after loading """
+    fh=open(filename, 'wb')
+    fh.write(self.state_file_magic)
+    self.reserve(len(self.ids))
+    header=json.dumps(options)
+    ids_block='\n'.join(self.ids.index2id)
+    events=self.history if not self.history is None else array('i', self.cluster_index2root.keys())
+    fh.write( struct.pack('<qqqqq', len(header), len(ids_block), len(self.ids), len(events), self.cluster_index) )
+    fh.write(header);    fh.write(ids_block)
+    n_ids=len(self.ids)
+    for a in (self.parent, self.size, self.next_member, self.tail, self.root2cluster_index):  a[:n_ids].tofile(fh)
+    events.tofile(fh)
+    fh.close()
+
+def load_clustering(filename):
+  """ Loads a clustering state saved with single_link_clustering.save. Returns a tuple (clustering, options). The clustering keeps recording its history """
+  fh=open(filename, 'rb')
+  if not fh.read( len(single_link_clustering.state_file_magic) ) in (single_link_clustering.state_file_magic, 'BHC_STATE_1\n'):  raise Exception, "ERROR {0} is not a clustering state file!".format(filename)
+  header_length, ids_block_length, n_ids, n_events, cluster_index = struct.unpack('<qqqqq', fh.read(40))
+  options=json.loads( fh.read(header_length) )
+  clusters=single_link_clustering(history=True)
+  ids_block=fh.read(ids_block_length)
+  if n_ids:
+    clusters.ids.index2id=ids_block.split('\n')
+    clusters.ids.id2index=dict( (gid, index) for index, gid in enumerate(clusters.ids.index2id) )
+  for attribute in ('parent', 'size', 'next_member', 'tail', 'root2cluster_index'):   getattr(clusters, attribute).fromfile(fh, n_ids)
+  clusters.history.fromfile(fh, n_events)
+  fh.close()
+  for c in clusters.history:      # replaying insertions and deletions, so that the dictionary iterates in the same order (BHC_STATE_1: insertions only)
+    if c>0:  clusters.cluster_index2root[c]=None
+    else:    del clusters.cluster_index2root[-c]
+  for root in xrange(n_ids):
+    if clusters.parent[root]==root:
+      clusters.cluster_index2root[ clusters.root2cluster_index[root] ]=root
+      if clusters.size[root]>clusters.largest: clusters.largest=clusters.size[root]
+  clusters.cluster_index=cluster_index
+  return clusters, options
+
+class hit_edges(object):
+  """ Edge list of the homology graph: integer ids (of id_table self.ids) of the two proteins of each hit passing the filters, with its evalue and bitscore.
+  Stored in compact arrays, in order of addition.  Usage:  e=hit_edges();  e.add_hit('protein1', 'protein2', 1e-30, 120.5) """
+  def __init__(self, ids=None):
+    if ids is None: ids=id_table()
+    self.ids=ids
+    self.left=array('i');  self.right=array('i');  self.evalue=array('d');  self.bitscore=array('d')
+  def __len__(self):   return len(self.left)
+  def add_link(self, index_left, index_right, evalue, bitscore=0.0):
+    self.left.append(index_left);  self.right.append(index_right);  self.evalue.append(evalue);  self.bitscore.append(bitscore)
+  def add_hit(self, id_left, id_right, evalue, bitscore=0.0):
+    """ Same as add_link, but accepting gene ids (strings) """
+    self.add_link( self.ids.index(id_left), self.ids.index(id_right), evalue, bitscore )
+  def extend(self, left_indexes, right_indexes, evalues, bitscores=None):
+    """ Adds many links at once, provided as numpy arrays (e.g. those yielded by iterate_m8_blocks). If bitscores is None, they are set to 0 """
+    if bitscores is None: bitscores=numpy.zeros(len(evalues))
+    for a, values, dtype in ( (self.left, left_indexes, numpy.int32), (self.right, right_indexes, numpy.int32), (self.evalue, evalues, numpy.float64), (self.bitscore, bitscores, numpy.float64) ):
+      a.fromstring( numpy.asarray(values, dtype=dtype).tostring() )
+
+  def columns(self):
+    """ Returns numpy arrays (views, valid until more links are added) for left, right, evalue, bitscore """
+    return ( numpy.frombuffer(self.left, dtype=numpy.int32), numpy.frombuffer(self.right, dtype=numpy.int32),
+             numpy.frombuffer(self.evalue, dtype=numpy.float64), numpy.frombuffer(self.bitscore, dtype=numpy.float64) )
+
+  def weights(self, weight='evalue'):
+    """ Returns a numpy array with the weight of each link. weight can be 'bitscore', or 'evalue' meaning -log10(evalue), capped to 300 """
+    left, right, evalues, bitscores = self.columns()
+    if   weight=='bitscore':   return bitscores.copy()
+    elif weight=='evalue':     return numpy.clip( -numpy.log10( numpy.maximum(evalues, 1e-300) ), 1e-3, 300.0 )
+    raise Exception, "ERROR unknown edge weight: {0} ; use evalue or bitscore".format(weight)
+
+  def adjacency_matrix(self, weight='evalue'):
+    """ Builds the symmetric sparse adjacency matrix of the graph, restricted to the ids with at least one link. When two proteins have more than one hit, the max weight is used.
+    Returns a tuple (nodes, matrix) where nodes is a sorted numpy array of integer ids, with the ids of rows and columns of matrix (scipy.sparse, csr format) """
+    left, right, evalues, bitscores = self.columns()
+    nodes=numpy.unique( numpy.concatenate( (left, right) ) )
+    n=len(nodes)
+    rows=numpy.searchsorted(nodes, left).astype(numpy.int64);    cols=numpy.searchsorted(nodes, right).astype(numpy.int64)
+    rows, cols = numpy.concatenate( (rows, cols) ), numpy.concatenate( (cols, rows) )
+    w=numpy.tile( self.weights(weight), 2 )
+    order=numpy.argsort(w, kind='mergesort')[::-1]    # best weights first, so they are kept when removing duplicates
+    unique_keys, first_positions = numpy.unique( rows[order]*n + cols[order], return_index=True )
+    keep=order[first_positions]
+    return nodes, sparse.csr_matrix( (w[keep], (rows[keep], cols[keep])), shape=(n, n) )
+
+  hits_cache_magic='BHC_HITS_1\n'
+  def save(self, filename, key={}):
+    """ Saves the edges to a compact binary file (hits cache), to be read with load_hit_edges. key is a dictionary (json serializable) describing where
+    they come from, used to decide whether the cache is still valid (see hits_cache_key) """
+    fh=open(filename, 'wb')
+    fh.write(self.hits_cache_magic)
+    header=json.dumps(key)
+    ids_block='\n'.join(self.ids.index2id)
+    fh.write( struct.pack('<qqqq', len(header), len(ids_block), len(self.ids), len(self)) )
+    fh.write(header);    fh.write(ids_block)
+    for a in (self.left, self.right, self.evalue, self.bitscore):  a.tofile(fh)
+    fh.close()
+
+def _read_hits_cache_header(fh):
+  if fh.read( len(hit_edges.hits_cache_magic) ) != hit_edges.hits_cache_magic:  return None
+  header_length, ids_block_length, n_ids, n_links = struct.unpack('<qqqq', fh.read(32))
+  return json.loads( fh.read(header_length) ), ids_block_length, n_ids, n_links
+
+def load_hit_edges(filename):
+  """ Loads a hits cache saved with hit_edges.save. Returns a tuple (edges, key) """
+  fh=open(filename, 'rb')
+  header=_read_hits_cache_header(fh)
+  if header is None: raise Exception, "ERROR {0} is not a hits cache file!".format(filename)
+  key, ids_block_length, n_ids, n_links = header
+  edges=hit_edges()
+  ids_block=fh.read(ids_block_length)
+  if n_ids:
+    edges.ids.index2id=ids_block.split('\n')
+    edges.ids.id2index=dict( (gid, index) for index, gid in enumerate(edges.ids.index2id) )
+  for a in (edges.left, edges.right, edges.evalue, edges.bitscore):   a.fromfile(fh, n_links)
+  fh.close()
+  return edges, key
+
+def hits_cache_key(input_file, **options):
+  """ Returns the key of a hits cache for input_file: a dictionary with its absolute path, size and modification time (microseconds), plus options,
+  i.e. anything else which determines which hits are kept (except the evalue threshold, see hits_cache_matches) """
+  st=os.stat(input_file)
+  key={'path':os.path.abspath(input_file), 'size':st.st_size, 'mtime':int(st.st_mtime*1000000)}
+  key.update(options)
+  return key
+
+def hits_cache_matches(cache_file, key, evalue_threshold):
+  """ Returns True if cache_file is a hits cache with this key (see hits_cache_key), saved with an evalue threshold (key 'e') not stricter than evalue_threshold """
+  if not os.path.isfile(cache_file): return False
+  fh=open(cache_file, 'rb');   header=_read_hits_cache_header(fh);   fh.close()
+  if header is None: return False
+  cached_key=dict(header[0])
+  cached_evalue_threshold=cached_key.pop('e', None)
+  return cached_key==json.loads(json.dumps(key)) and cached_evalue_threshold is not None and evalue_threshold <= cached_evalue_threshold
+
+def iterate_edges_hits(edges, evalue_threshold, species_function=None, stats=None):
+  """ Generator of the links of a hit_edges (e.g. a hits cache) which pass the filters, yielded as hits (subject, query, evalue, bitscore) in their order,
+  as iterate_m8_hits does. Filters and stats are as in filter_hits """
+  ids=edges.ids
+  return filter_hits( ( (ids[index_left], ids[index_right], evalue, bitscore) for index_left, index_right, evalue, bitscore in izip(edges.left, edges.right, edges.evalue, edges.bitscore) ),
+                      evalue_threshold, species_function, stats )
+
+
+def sweep_families(edges, thresholds, min_size=0):
+  """ Single link clustering of a hit_edges object at many evalue thresholds in a single pass: links are sorted by evalue and added to the same
+  single_link_clustering from the strictest to the loosest threshold. Generator of tuples (threshold, families), strictest threshold first;
+  families are as returned by single_link_clustering.families """
+  if numpy is not None:   order=numpy.argsort( edges.columns()[2], kind='mergesort' ).tolist()   #stable: hits with same evalue are kept in file order
+  else:                   order=sorted( xrange(len(edges)), key=edges.evalue.__getitem__ )
+  clusters=single_link_clustering(edges.ids)
+  left, right, evalues = edges.left, edges.right, edges.evalue
+  position=0
+  for threshold in sorted(thresholds):
+    while position < len(order) and evalues[ order[position] ] < threshold:
+      clusters.add_link( left[order[position]], right[order[position]] )
+      position+=1
+    yield threshold, clusters.families(min_size)
+
+###############################################################################################
+###### out-of-core single link clustering: ids and union-find arrays in memory-mapped files, for inputs with more distinct ids than what fits in memory
+
+def parse_memory_size(size_string):
+  """ Converts a memory size such as 8G, 500M, 1.5G or 1000000 (bytes) to a number of bytes """
+  units={'K':2**10, 'M':2**20, 'G':2**30, 'T':2**40}
+  size_string=str(size_string).strip().upper().rstrip('B')
+  if size_string and size_string[-1] in units:  return int( float(size_string[:-1])*units[size_string[-1]] )
+  return int( float(size_string) )
+
+def disk_int_array(filename, length):
+  """ Creates a file of length 32 bit integers, all set to -1, and returns it memory-mapped as a ctypes array, which can be used like a fixed length array('i') """
+  fh=open(filename, 'w+b')
+  block='\xff'*2**20;    remaining=max(length, 1)*4
+  while remaining>0:
+    fh.write( block[:remaining] );    remaining-=len(block)
+  fh.flush()
+  mm=mmap.mmap(fh.fileno(), max(length, 1)*4)
+  fh.close()
+  return (ctypes.c_int32*length).from_buffer(mm)    # the ctypes array keeps a reference to the mmap
+
+class disk_id_table(object):
+  """ Read-only table of gene ids on disk, built by external_single_link_clustering. The index of each id is its rank when sorted by hash (python builtin hash, 64 bit).
+  Files in folder:  ids.hash (sorted hashes, int64), ids.offset (int64 offsets of each id in ids.txt, plus its end), ids.txt (all ids concatenated) """
+  def __init__(self, folder):
+    self.folder=folder
+    if os.path.getsize( os.path.join(folder, 'ids.hash') ):
+      self.hashes= numpy.memmap( os.path.join(folder, 'ids.hash'),   dtype=numpy.int64, mode='r' )
+      self.offsets=numpy.memmap( os.path.join(folder, 'ids.offset'), dtype=numpy.int64, mode='r' )
+    else:   self.hashes=numpy.zeros(0, dtype=numpy.int64);   self.offsets=numpy.zeros(1, dtype=numpy.int64)
+    self.fh=open( os.path.join(folder, 'ids.txt'), 'rb' )
+    self.strings=mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] else ''
+  def __len__(self):             return len(self.hashes)
+  def __getitem__(self, index):  return self.strings[ int(self.offsets[index]):int(self.offsets[index+1]) ]
+  def indexes(self, hashes):
+    """ Returns a numpy array with the indexes of the ids with these hashes (numpy array), which must be in the table """
+    return numpy.searchsorted(self.hashes, hashes)
+  def __contains__(self, gid):
+    index=int( numpy.searchsorted(self.hashes, hash(gid)) )
+    return index<len(self.hashes) and self.hashes[index]==hash(gid) and self[index]==gid
+  def index(self, gid):
+    """ Returns the index of gid; unlike id_table.index, ids cannot be added """
+    if not gid in self: raise KeyError, gid
+    return int( numpy.searchsorted(self.hashes, hash(gid)) )
+
+def _write_id_run(filename, run):
+  fh=open(filename, 'wb')
+  for id_hash in sorted(run):   fh.write( '{0}\t{1}\n'.format(id_hash, run[id_hash]) )
+  fh.close()
+
+def _read_id_run(filename):
+  for line in open(filename, 'rb'):
+    id_hash, gid = line.rstrip('\n').split('\t', 1)
+    yield int(id_hash), gid
+
+def hash_collision_error(gid, other_gid):
+  return Exception( "ERROR gene ids {0} and {1} have the same hash: out-of-core clustering cannot be used with this input".format(gid, other_gid) )
+
+def build_disk_id_table(run_files, folder):
+  """ Merges the sorted runs of (hash, id) written during the first pass of external_single_link_clustering into the files of a disk_id_table in folder """
+  hash_fh=open(os.path.join(folder, 'ids.hash'), 'wb');   offset_fh=open(os.path.join(folder, 'ids.offset'), 'wb');  txt_fh=open(os.path.join(folder, 'ids.txt'), 'wb')
+  hashes=array(int64_typecode);  offsets=array(int64_typecode, [0]);  offset=0
+  previous_hash, previous_id = None, None
+  for id_hash, gid in heapq.merge( *[_read_id_run(f) for f in run_files] ):
+    if id_hash==previous_hash:
+      if gid!=previous_id:  raise hash_collision_error(gid, previous_id)
+      continue
+    hashes.append(id_hash);   offset+=len(gid);   offsets.append(offset);   txt_fh.write(gid)
+    previous_hash, previous_id = id_hash, gid
+    if len(hashes)>=2**16:
+      hashes.tofile(hash_fh);  offsets.tofile(offset_fh);   del hashes[:];  del offsets[:]
+  hashes.tofile(hash_fh);  offsets.tofile(offset_fh)
+  for fh in (hash_fh, offset_fh, txt_fh): fh.close()
+  return disk_id_table(folder)
+
+class disk_cluster_table(object):
+  """ Used in place of the cluster_index2root dictionary of single_link_clustering by disk_single_link_clustering: a memory-mapped array with the root
+  of each cluster index, or -1 if there is no such cluster (anymore). Each new cluster takes two ids never linked before, so capacity n_ids/2+2 is enough """
+  def __init__(self, filename, capacity):
+    self.roots_array=disk_int_array(filename, capacity)
+    self.n_clusters=0
+  def __len__(self):  return self.n_clusters
+  def __setitem__(self, cluster_index, root):
+    if self.roots_array[cluster_index]<0:   self.n_clusters+=1
+    self.roots_array[cluster_index]=root
+  def __delitem__(self, cluster_index):
+    self.roots_array[cluster_index]=-1;   self.n_clusters-=1
+  def roots(self):
+    """ Returns a numpy array with the roots of all clusters, in order of cluster index """
+    roots_array=numpy.frombuffer(buffer(self.roots_array), dtype=numpy.int32)
+    return roots_array[ roots_array>=0 ]
+  def values(self):   return self.roots().tolist()
+
+class family_list(object):
+  """ List-like sequence of the families of a clustering, each one a list of gene ids, which are materialized only when iterated. roots: ordered roots of the families """
+  def __init__(self, clusters, roots):
+    self.clusters=clusters;   self.roots=roots
+  def __len__(self):  return len(self.roots)
+  def __iter__(self):
+    ids=self.clusters.ids
+    for root in self.roots:   yield [ ids[i] for i in self.clusters.member_indexes(int(root)) ]
+
+class disk_single_link_clustering(single_link_clustering):
+  """ single_link_clustering for a fixed set of ids (a disk_id_table), whose arrays are memory-mapped files in folder, so that the operating system keeps in
+  memory only what fits. The dictionary of clusters is replaced by a disk_cluster_table; thus families of the same size are ordered by cluster index
+  (i.e. order of creation), and not as single_link_clustering does. Families themselves, and the order of their members, are the same """
+  def __init__(self, ids, folder):
+    self.ids=ids
+    for attribute in ('parent', 'size', 'next_member', 'tail', 'root2cluster_index'):   setattr(self, attribute, disk_int_array(os.path.join(folder, attribute), len(ids)) )
+    self.cluster_index2root=disk_cluster_table( os.path.join(folder, 'cluster_index2root'), len(ids)/2+2 )
+    self.history=None
+    self.cluster_index=1
+    self.n_merges=0;  self.n_moved=0;  self.largest=0
+
+  def reserve(self, n):
+    if n>len(self.parent): raise Exception, "ERROR disk_single_link_clustering has room only for the {0} ids of its table!".format(len(self.parent))
+
+  def ordered_roots(self, min_size=0):
+    """ Returns a numpy array with the roots of all clusters, largest first (ties: in order of creation). Clusters with less than min_size members are omitted """
+    roots=self.cluster_index2root.roots()
+    sizes=numpy.frombuffer(buffer(self.size), dtype=numpy.int32)[roots]
+    order=numpy.argsort(-sizes, kind='mergesort')
+    if min_size:  order=order[ sizes[order]>=min_size ]
+    return roots[order]
+
+  def families(self, min_size=0):
+    """ Returns a family_list, whose families are lists of gene ids. Largest families first; those with less than min_size members are omitted """
+    return family_list( self, self.ordered_roots(min_size) )
+
+  def save(self, filename, options={}):  raise Exception, "ERROR disk_single_link_clustering cannot be saved!"
+
+def external_single_link_clustering(hits, folder, memory_budget, stats=None):
+  """ Out-of-core single link clustering of hits, an iterable of tuples (id_left, id_right, ...) such as yielded by iterate_m8_hits. Memory use is kept
+  within about memory_budget bytes (besides what is memory-mapped, which the operating system can page out); files are written in folder.
+    pass 1: hits are consumed once. The hashes of their two ids are written to a file, and ids are collected in sorted runs of (hash, id), spilled to disk
+            when the budget is reached. Runs are merged into a disk_id_table
+    pass 2: the file of hashes is read in chunks, converted to id indexes (binary search on the sorted hashes) and fed to a disk_single_link_clustering
+  Returns the disk_single_link_clustering. Its families are the same as those of single_link_clustering fed with the same hits (see disk_single_link_clustering
+  for their order). If a run_stats is provided, stages 'parse' (consuming hits), 'intern' (ids) and 'merge' (pass 2) are timed in it. Requires numpy """
+  if numpy is None: raise Exception, "ERROR numpy is required for out-of-core clustering!"
+  ids_per_run=  max( memory_budget/4/160, 1000 )     # a run costs ~160 bytes per id (string, hash, dictionary slot)
+  pairs_per_chunk=max( memory_budget/4/80, 1000 )    # a chunk costs ~80 bytes per pair (numpy arrays and lists of python ints)
+  pairs_fh=open(os.path.join(folder, 'pairs'), 'wb')
+  pairs=array(int64_typecode);   run={};   run_files=[]
+  if stats is None:   iterator=iter(hits);   batches=iter( lambda:list(islice(iterator, 65536)), [] )
+  else:               batches=stats.timed_batches(hits, 'parse')
+  for batch in batches:
+    if stats is not None:   stats.start('intern')
+    for hit in batch:
+      id_left, id_right = hit[0], hit[1]
+      hash_left, hash_right = hash(id_left), hash(id_right)
+      if run.setdefault(hash_left, id_left)!=id_left:      raise hash_collision_error(id_left, run[hash_left])
+      if run.setdefault(hash_right, id_right)!=id_right:   raise hash_collision_error(id_right, run[hash_right])
+      pairs.append(hash_left);   pairs.append(hash_right)
+    pairs.tofile(pairs_fh);    del pairs[:]
+    if len(run)>=ids_per_run:
+      run_files.append( os.path.join(folder, 'ids.run{0}'.format(len(run_files)+1)) );   _write_id_run(run_files[-1], run);   run={}
+    if stats is not None:   stats.stop()
+  pairs_fh.close()
+  if stats is not None:   stats.start('intern')
+  if run or not run_files:
+    run_files.append( os.path.join(folder, 'ids.run{0}'.format(len(run_files)+1)) );   _write_id_run(run_files[-1], run)
+  del run
+  ids=build_disk_id_table(run_files, folder)
+  for f in run_files: os.remove(f)
+  if stats is not None:   stats.stop();  stats.start('merge')
+  clusters=disk_single_link_clustering(ids, folder)
+  pairs_fh=open(os.path.join(folder, 'pairs'), 'rb')
+  while True:
+    chunk=numpy.fromfile(pairs_fh, dtype=numpy.int64, count=2*pairs_per_chunk)
+    if not len(chunk): break
+    indexes=ids.indexes(chunk)
+    clusters.add_links( indexes[0::2].tolist(), indexes[1::2].tolist() )
+    if stats is not None:   stats.snapshot(clusters)
+  pairs_fh.close()
+  os.remove(os.path.join(folder, 'pairs'))
+  if stats is not None:   stats.stop()
+  return clusters
+
+###############################################################################################
+###### partial component files: clustering of input shards separately (map step), then merging their results (reduce step)
+# layout: magic; header (struct '<qqqq': length of options, length of ids block, n_ids, n_components); options (json); ids joined by newlines, grouped
+#         by component (components in the order of families, largest first; members in their order); component of each id (int32, 0-based)
+
+partial_components_magic='BHC_PARTIAL_1\n'
+def write_partial_components(filename, families, options={}):
+  """ Writes the families of the clustering of one input shard to a partial component file, to be merged later with others (see partial_component_hits).
+  families is an iterable of lists of gene ids (such as returned by single_link_clustering.families), which is read only once.
+  options is a dictionary (json serializable) with the run options, stored to check that all merged files are compatible """
+  fh=open(filename, 'wb')
+  fh.write(partial_components_magic)
+  header=json.dumps(options)
+  fh.write( struct.pack('<qqqq', 0, 0, 0, 0) );    fh.write(header)    # header is rewritten at the end
+  components=array('i');   ids_block_length=0
+  for component_index, family in enumerate(families):
+    block='\n'.join(family)
+    fh.write( '\n'+block if components else block );   ids_block_length+=len(block)+bool(components)
+    components.extend( array('i', [component_index])*len(family) )
+  components.tofile(fh)
+  n_components=components[-1]+1 if components else 0
+  fh.seek( len(partial_components_magic) );   fh.write( struct.pack('<qqqq', len(header), ids_block_length, len(components), n_components) )
+  fh.close()
+
+def is_partial_components(filename):
+  """ Returns True if filename is a partial component file (see write_partial_components) """
+  return file_starts_with(filename, partial_components_magic)
+
+def _read_partial_header(fh, filename):
+  if fh.read( len(partial_components_magic) ) != partial_components_magic:  raise Exception, "ERROR {0} is not a partial component file!".format(filename)
+  header_length, ids_block_length, n_ids, n_components = struct.unpack('<qqqq', fh.read(32))
+  return json.loads( fh.read(header_length) ), ids_block_length, n_ids, n_components
+
+def partial_components_options(filenames):
+  """ Returns the options stored in partial component files, checking that they are the same for all of them """
+  options=None
+  for filename in filenames:
+    fh=open(filename, 'rb');   file_options=_read_partial_header(fh, filename)[0];   fh.close()
+    if options is None:  options, first_filename = file_options, filename
+    elif file_options!=options:   raise Exception, "ERROR partial component files {0} and {1} were built with different options: {2} , {3}".format(first_filename, filename, options, file_options)
+  return options
+
+def iterate_partial_components(filename):
+  """ Generator of the components (lists of gene ids) of a partial component file, in their order """
+  fh=open(filename, 'rb')
+  options, ids_block_length, n_ids, n_components = _read_partial_header(fh, filename)
+  ids=fh.read(ids_block_length).split('\n') if n_ids else []
+  components=array('i');   components.fromfile(fh, n_ids)
+  fh.close()
+  start=0
+  for end in xrange(1, n_ids+1):
+    if end==n_ids or components[end]!=components[start]:
+      yield ids[start:end];   start=end
+
+def partial_component_hits(filenames):
+  """ Generator of the links which merge partial component files (reduce step), as hit tuples (id_left, id_right, evalue, bitscore) linking the first member
+  of each component to the others, with evalue and bitscore 0.0. Files are read in order. Feeding these to a single_link_clustering gives the same
+  families as clustering the shards all together; the order of members and of families of the same size may differ """
+  for filename in filenames:
+    for component in iterate_partial_components(filename):
+      first=component[0]
+      for gid in component[1:]:  yield first, gid, 0.0, 0.0
+
+###############################################################################################
+###### binary string indexes: sorted keys in a memory-mapped string table, each with a numeric value, for fast lookups of few keys
+# layout: magic; extra header (specific of each index type); n_keys and length of string table (int64); offsets of each key in the string table
+#         (n_keys+1 int64); value of each key (n_keys, typecode specific of each index type); string table with all keys concatenated, sorted. Native byte order
+
+int64_typecode= 'l' if array('l').itemsize==8 else 'q'   #python2 arrays have no 'q' typecode
+def write_string_index(filename, magic, items, value_typecode, extra_header=''):
+  """ Writes a binary string index. items is a list of (key, value) sorted by key, without duplicated keys; values are stored with the array value_typecode """
+  offsets=array(int64_typecode, [0]);  values=array(value_typecode)
+  for key, value in items:
+    offsets.append( offsets[-1]+len(key) );   values.append( value )
+  fh=open(filename, 'wb')
+  fh.write(magic);   fh.write(extra_header)
+  fh.write( struct.pack('=qq', len(items), offsets[-1]) )
+  offsets.tofile(fh);   values.tofile(fh)
+  for key, value in items:   fh.write(key)
+  fh.close()
+
+def file_starts_with(filename, start):
+  """ Returns True if the file content starts with the string start """
+  fh=open(filename, 'rb');   file_start=fh.read(len(start));  fh.close()
+  return file_start==start
+
+class string_index(object):
+  """ Read-only access to a binary string index (see write_string_index). The file is memory-mapped and each lookup is a binary search on the sorted keys,
+  so that nothing is loaded in memory except the keys actually looked up (which are cached). Subclasses define magic, value_typecode and extra_header_length """
+  magic=None;  value_typecode='i';  extra_header_length=0
+  def __init__(self, filename):
+    self.filename=filename
+    self.fh=open(filename, 'rb')
+    self.mm=mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if self.mm[:len(self.magic)] != self.magic: raise Exception, "ERROR {0} is not a {1} file!".format(filename, self.__class__.__name__)
+    self.extra_header=self.mm[ len(self.magic) : len(self.magic)+self.extra_header_length ]
+    self.n_keys, strings_length = struct.unpack_from('=qq', self.mm, len(self.magic)+self.extra_header_length)
+    self.offsets_start=len(self.magic)+self.extra_header_length+16
+    self.value_size=array(self.value_typecode).itemsize
+    self.values_start=self.offsets_start + 8*(self.n_keys+1)
+    self.strings_start=self.values_start + self.value_size*self.n_keys
+    self.cache={}
+  def __len__(self):  return self.n_keys
+  def _key(self, index):
+    start, end = struct.unpack_from('=qq', self.mm, self.offsets_start + 8*index)
+    return self.mm[self.strings_start+start:self.strings_start+end]
+  def lookup(self, key):
+    """ Returns the value of key, or None if not present """
+    if key in self.cache: return self.cache[key]
+    low, high = 0, self.n_keys
+    while low < high:
+      middle=(low+high)/2
+      if self._key(middle) < key: low=middle+1
+      else:                       high=middle
+    value=None
+    if low < self.n_keys and self._key(low)==key:
+      value=array(self.value_typecode, self.mm[ self.values_start+self.value_size*low : self.values_start+self.value_size*(low+1) ])[0]
+    self.cache[key]=value
+    return value
+  def close(self):
+    self.mm.close();  self.fh.close()
+
+###### gene-to-family index: same content as -A output of blast_homology_clusters.py. Values are family numbers (e.g. 3 for F3); extra header is the number of families
+
+family_index_magic='BHC_FAMILY_INDEX_1\n'
+def write_family_index(filename, families):
+  """ Writes a binary gene-to-family index for families, which is a list of lists of gene ids (such as returned by single_link_clustering.families).
+  Families are named F1, F2 ... in this order, as in the -A output of blast_homology_clusters.py. Read it with class family_index """
+  gene_fams=sorted( (gid, fam_index+1) for fam_index, family in enumerate(families) for gid in family )
+  write_string_index(filename, family_index_magic, gene_fams, 'i', struct.pack('=q', len(families)))
+
+def is_family_index(filename):
+  """ Returns True if filename is a binary gene-to-family index (see write_family_index), False if it is anything else (e.g. a tab separated file) """
+  return file_starts_with(filename, family_index_magic)
+
+class family_index(string_index):
+  """ Read-only, dictionary-like access to a binary gene-to-family index written by write_family_index (see string_index).
+  Usage:  geneid2family=family_index('families.idx');   if 'protein1' in geneid2family: print geneid2family['protein1']   # --> 'F3' """
+  magic=family_index_magic;  value_typecode='i';  extra_header_length=8
+  def __init__(self, filename):
+    string_index.__init__(self, filename)
+    self.n_genes=self.n_keys
+    self.n_families=struct.unpack('=q', self.extra_header)[0]
+  def __contains__(self, gid):  return self.lookup(gid) is not None
+  def __getitem__(self, gid):
+    fam_number=self.lookup(gid)
+    if fam_number is None: raise KeyError, gid
+    return 'F'+str(fam_number)
+  def get(self, gid, default=None):
+    fam_number=self.lookup(gid)
+    return default if fam_number is None else 'F'+str(fam_number)
+
+###### fasta title index: values are byte offsets of header lines in a fasta file; extra header is the fingerprint of the fasta file (size, mtime)
+
+fasta_title_index_magic='BHC_FASTA_TITLES_1\n'
+def fasta_fingerprint(fasta_file):
+  """ Returns the extra header of fasta title indexes: size and modification time (microseconds) of the fasta file, packed """
+  st=os.stat(fasta_file)
+  return struct.pack('=qq', st.st_size, int(st.st_mtime*1000000))
+
+def iterate_fasta_headers(fh, block_size=2**24):
+  """ Generator of tuples (byte_offset, title) for the header lines of a fasta file (title is without the initial >), given an open file handle.
+  The file is scanned in large blocks looking only for header lines, so sequence lines are never split nor copied """
+  block_start=0;   at_line_start=True
+  while True:
+    block=fh.read(block_size)
+    if not block: break
+    if at_line_start and block[0]=='>':  position=0
+    else:
+      position=block.find('\n>')
+      if position>=0: position+=1
+    while position>=0:
+      end=block.find('\n', position)
+      while end<0:                         #header line continues in next block
+        more=fh.read(block_size)
+        if not more:  end=len(block);  break
+        block+=more;  end=block.find('\n', position)
+      yield block_start+position, block[position+1:end].rstrip('\r')
+      position=block.find('\n>', end)
+      if position>=0: position+=1
+    at_line_start=block.endswith('\n')
+    block_start+=len(block)
+
+def build_fasta_title_index(fasta_file, index_file):
+  """ Writes a fasta title index for fasta_file (uncompressed) in a single streaming pass. Ids are the first word of titles; if duplicated, the last is kept """
+  fh=open(fasta_file, 'rb')
+  id2offset=dict( ((title.split() or [''])[0], offset) for offset, title in iterate_fasta_headers(fh) )
+  fh.close()
+  write_string_index(index_file, fasta_title_index_magic, sorted(id2offset.items()), int64_typecode, fasta_fingerprint(fasta_file))
+
+class fasta_title_index(string_index):
+  """ Read-only, dictionary-like access (id --> full title) to the titles of a fasta file through its title index (see build_fasta_title_index).
+  Titles are read from the fasta file only when looked up.  Usage:  titles=fasta_title_index('proteins.fa.tidx', 'proteins.fa');  titles['protein1'] """
+  magic=fasta_title_index_magic;  value_typecode=int64_typecode;  extra_header_length=16
+  def __init__(self, index_file, fasta_file):
+    string_index.__init__(self, index_file)
+    self.fasta_fh=open(fasta_file, 'rb')
+  def __contains__(self, gid):  return self.lookup(gid) is not None
+  def __getitem__(self, gid):
+    offset=self.lookup(gid)
+    if offset is None: raise KeyError, gid
+    self.fasta_fh.seek(offset)
+    return self.fasta_fh.readline()[1:].rstrip('\r\n')
+  def get(self, gid, default=None):
+    try:              return self[gid]
+    except KeyError:  return default
+  def close(self):
+    string_index.close(self);  self.fasta_fh.close()
+
+def load_fasta_titles(fasta_file, index_file=None):
+  """ Returns a dictionary-like object id --> full title (without >) for the sequences in fasta_file. Ids are the first word of titles.
+  For uncompressed files, this is a fasta_title_index using index_file (default: fasta_file+'.tidx'), which is built if missing or outdated and reused
+  in later runs; if it cannot be written there, a temporary index is used instead. For compressed files, titles are loaded in a dictionary """
+  if compression_format(fasta_file):
+    return dict( ((title.split() or [''])[0], title) for offset, title in iterate_fasta_headers(open_input(fasta_file)) )
+  if index_file is None: index_file=fasta_file+'.tidx'
+  if os.path.isfile(index_file) and file_starts_with(index_file, fasta_title_index_magic+fasta_fingerprint(fasta_file)):
+    return fasta_title_index(index_file, fasta_file)
+  try:
+    build_fasta_title_index(fasta_file, index_file)
+    return fasta_title_index(index_file, fasta_file)
+  except (IOError, OSError):
+    import tempfile
+    temp_fd, temp_index_file = tempfile.mkstemp(suffix='.tidx');   os.close(temp_fd)
+    build_fasta_title_index(fasta_file, temp_index_file)
+    titles=fasta_title_index(temp_index_file, fasta_file)
+    os.remove(temp_index_file)      #still accessible through the open memory map
+    return titles
+
+###############################################################################################
+###### compressed input files
+
+compression_magic_bytes={'gzip':'\x1f\x8b', 'bz2':'BZh', 'xz':'\xfd7zXZ\x00'}
+def compression_format(filename):
+  """ Returns the compression format of a file (gzip, bz2 or xz) detected by its magic bytes, or None if it is not compressed """
+  fh=open(filename, 'rb');  start=fh.read(6);  fh.close()
+  for compression, magic in compression_magic_bytes.items():
+    if start.startswith(magic): return compression
+  return None
+
+class threaded_decompressor(object):
+  """ Read-only file-like object (read, readline, iteration by lines) for a gzip, bz2 or xz compressed file. Decompression runs in a background thread,
+  which feeds the reader through a bounded queue of decompressed blocks, so that decompression and parsing overlap.
+  Concatenated streams (e.g. as produced by cat file1.gz file2.gz) are supported. For xz, if module lzma is not available, the xz program is used.  Usage:  for line in threaded_decompressor('hits.tab.gz'): ... """
+  block_size=2**20
+  def __init__(self, filename, max_buffered_blocks=16):
+    self.filename=filename
+    self.compression=compression_format(filename)
+    if   self.compression is None:               raise Exception, "ERROR threaded_decompressor: file {0} is not compressed with gzip, bz2 or xz!".format(filename)
+    self.queue=Queue.Queue(max_buffered_blocks)
+    self.buffer='';   self.position=0;   self.finished=False;   self.error=None     #self.position: how much of self.buffer was already read
+    self.thread=threading.Thread(target=self._decompress);   self.thread.daemon=True;   self.thread.start()
+
+  def _new_decompressor(self):
+    if   self.compression=='gzip':   return zlib.decompressobj(16+zlib.MAX_WBITS)
+    elif self.compression=='bz2':    return bz2.BZ2Decompressor()
+    elif self.compression=='xz':     return lzma.LZMADecompressor()
+
+  def _decompress(self):
+    """ Run in the background thread """
+    try:
+      if self.compression=='xz' and lzma is None:     # no python module available: using the xz program
+        import subprocess
+        process=subprocess.Popen(['xz', '-dc', self.filename], stdout=subprocess.PIPE)
+        for data in iter( lambda:process.stdout.read(self.block_size), '' ): self.queue.put(data)
+        if process.wait(): raise Exception, "xz exited with status {0}".format(process.returncode)
+        return
+      fh=open(self.filename, 'rb')
+      decompressor=self._new_decompressor()
+      for raw in iter( lambda:fh.read(self.block_size), '' ):
+        while raw:
+          data=decompressor.decompress(raw)
+          if data: self.queue.put(data)
+          raw=decompressor.unused_data      #not empty only at the end of a stream, if another one follows
+          if raw: decompressor=self._new_decompressor()
+      if hasattr(decompressor, 'flush'):
+        data=decompressor.flush()
+        if data: self.queue.put(data)
+      fh.close()
+    except Exception, e:   self.error=e
+    finally:               self.queue.put(None)
+
+  def _fill(self):
+    """ Adds the next decompressed block to self.buffer, dropping what was already read; sets self.finished at the end """
+    data=self.queue.get()
+    if data is None:
+      self.finished=True
+      if self.error is not None: raise Exception, "ERROR decompressing {0}: {1}".format(self.filename, self.error)
+    else:
+      self.buffer=self.buffer[self.position:]+data;   self.position=0
+
+  def read(self, size=-1):
+    while not self.finished and (size<0 or len(self.buffer)-self.position<size): self._fill()
+    end= len(self.buffer) if size<0 else self.position+size
+    out=self.buffer[self.position:end];   self.position=min(end, len(self.buffer))
+    return out
+
+  def readline(self):
+    end=self.buffer.find('\n', self.position)
+    while end<0 and not self.finished:
+      searched=len(self.buffer)-self.position
+      self._fill()
+      end=self.buffer.find('\n', self.position+searched)
+    end= end+1 if end>=0 else len(self.buffer)
+    out=self.buffer[self.position:end];   self.position=end
+    return out
+
+  def __iter__(self):
+    while True:
+      if not self.finished: self._fill()
+      lines=self.buffer[self.position:].split('\n')
+      self.buffer=lines.pop();   self.position=0          #incomplete last line
+      for line in lines:   yield line+'\n'
+      if self.finished:
+        if self.buffer: yield self.buffer
+        self.buffer=''
+        return
+
+  def close(self):    pass
+
+def open_input(filename):
+  """ Opens a file for reading; if compressed (gzip, bz2, xz), returns a threaded_decompressor instead """
+  if compression_format(filename): return threaded_decompressor(filename)
+  return open(filename, 'rb')
+
+def decompress_to_fifo(filename, fifo_path):
+  """ Creates a named pipe in fifo_path and starts a background thread that writes into it the decompressed content of filename (see threaded_decompressor).
+  This is for parsers which accept only a file path. Returns fifo_path """
+  os.mkfifo(fifo_path)
+  def feed_fifo():
+    source=threaded_decompressor(filename)
+    try:
+      out=open(fifo_path, 'wb')
+      for data in iter( lambda:source.read(source.block_size), '' ): out.write(data)
+      out.close()
+    except IOError: pass     #reader closed the pipe before the end
+  thread=threading.Thread(target=feed_fifo);   thread.daemon=True;   thread.start()
+  return fifo_path
+
+###############################################################################################
+###### reading tabular blast output (m8)
+# columns: query, subject, %identity, alignment length, mismatches, gap openings, q.start, q.end, s.start, s.end, evalue, bitscore
+
+def m8_evalue(evalue_string):
+  """ Converts an evalue string as found in blast output to float. Older blast versions write things like e-180, meaning 1e-180 """
+  if evalue_string[0]=='e': evalue_string='1'+evalue_string
+  return float(evalue_string)
+
+def cached_function(function):
+  """ Returns a version of function (of one hashable argument) which computes its value only once for each argument, keeping results in a dictionary.
+  Used for species functions, so that the species of each gene id is computed only once """
+  cache={}
+  def cached(x):
+    try:              return cache[x]
+    except KeyError:  value=cache[x]=function(x);   return value
+  return cached
+
+def _divide(a, b):
+  """ Division used by compound_filter, for single values as for numpy arrays: division by zero gives nan, so that comparisons with the result fail """
+  if numpy is not None and ( isinstance(a, numpy.ndarray) or isinstance(b, numpy.ndarray) ):
+    with numpy.errstate(divide='ignore', invalid='ignore'):   return numpy.where( b==0, numpy.nan, numpy.true_divide(a, b) )
+  return a*1.0/b if b else float('nan')
+
+class _division_to_call(ast.NodeTransformer):
+  """ Replaces each division a/b in a python expression tree with _divide(a, b) """
+  def visit_BinOp(self, node):
+    self.generic_visit(node)
+    if not isinstance(node.op, ast.Div): return node
+    return ast.copy_location( ast.Call( func=ast.Name(id='_divide', ctx=ast.Load()), args=[node.left, node.right], keywords=[], starargs=None, kwargs=None ), node )
+
+class compound_filter(object):
+  """ Filter on the columns of tabular blast output, given as a python-like expression, e.g.   bitscore>=50 and pident>=30 and qcov>=50
+  Names available: pident, length, mismatch, gapopen, qstart, qend, sstart, send, evalue, bitscore (standard m8 columns); qlen, slen (two more columns,
+  as in blast+ -outfmt '6 std qlen slen'); qcov, scov (coverage of query and subject by the alignment, in percent; they require qlen and slen).
+  Allowed: and, or, not, comparisons (also chained, e.g. 30<pident<90), numbers, + - * / and abs(). Division by zero (also qcov, scov with qlen, slen 0)
+  gives nan, so that any comparison with it is false (except !=), the same way for single lines and for blocks.
+  The expression is validated and compiled only once, in two forms:  accepts(fields) tests a single line split by tab;  mask(fields, n_columns) tests a
+  block of lines at once, provided as a flat list of their fields (see iterate_m8_blocks), and returns a numpy boolean array """
+  column_indexes={'pident':2, 'length':3, 'mismatch':4, 'gapopen':5, 'qstart':6, 'qend':7, 'sstart':8, 'send':9, 'evalue':10, 'bitscore':11, 'qlen':12, 'slen':13}
+  coverage_columns={'qcov':('qstart', 'qend', 'qlen'), 'scov':('sstart', 'send', 'slen')}
+  binary_operators={ ast.Add:operator.add, ast.Sub:operator.sub, ast.Mult:operator.mul, ast.Div:_divide }
+  comparison_operators={ ast.Lt:operator.lt, ast.LtE:operator.le, ast.Gt:operator.gt, ast.GtE:operator.ge, ast.Eq:operator.eq, ast.NotEq:operator.ne }
+
+  def __init__(self, expression):
+    self.expression=expression.strip()
+    try:                 tree=ast.parse(self.expression, mode='eval')
+    except SyntaxError:  raise Exception, "ERROR invalid filter expression: {0}".format(self.expression)
+    self.names=set()
+    self.vector_function=self._compile(tree.body)
+    self.names=sorted(self.names)
+    row_tree=_division_to_call().visit( ast.parse( 'lambda {0}: {1}'.format(', '.join(self.names), self.expression), mode='eval' ) )
+    self.row_function=eval( compile( ast.fix_missing_locations(row_tree), '<filter>', 'eval' ), {'abs':abs, '_divide':_divide} )
+    self.column_names=sorted( set( c for name in self.names for c in self.coverage_columns.get(name, [name]) ), key=self.column_indexes.get )
+    self.n_columns_needed=self.column_indexes[ self.column_names[-1] ]+1 if self.column_names else 0
+
+  def _compile(self, node):
+    """ Returns a function which computes the value of the expression node, given a dictionary with the values (numpy arrays) of each name """
+    if isinstance(node, ast.BoolOp):
+      parts=[ self._compile(value) for value in node.values ]
+      combine='logical_and' if isinstance(node.op, ast.And) else 'logical_or'     # numpy is looked up only when called (see mask)
+      return lambda values: reduce( getattr(numpy, combine), [part(values) for part in parts] )
+    if isinstance(node, ast.UnaryOp):
+      operand=self._compile(node.operand)
+      if isinstance(node.op, ast.Not):   return lambda values: numpy.logical_not( operand(values) )
+      if isinstance(node.op, ast.USub):  return lambda values: -operand(values)
+      if isinstance(node.op, ast.UAdd):  return operand
+    if isinstance(node, ast.BinOp) and type(node.op) in self.binary_operators:
+      left, right, function = self._compile(node.left), self._compile(node.right), self.binary_operators[type(node.op)]
+      return lambda values: function( left(values), right(values) )
+    if isinstance(node, ast.Compare) and all( type(op) in self.comparison_operators for op in node.ops ):
+      operands=[ self._compile(node.left) ] + [ self._compile(comparator) for comparator in node.comparators ]
+      functions=[ self.comparison_operators[type(op)] for op in node.ops ]
+      def compare(values):
+        computed=[ operand(values) for operand in operands ]
+        return reduce( numpy.logical_and, [ function(computed[i], computed[i+1]) for i, function in enumerate(functions) ] )
+      return compare
+    if isinstance(node, ast.Num):
+      number=node.n
+      return lambda values: number
+    if isinstance(node, ast.Name):
+      if not (node.id in self.column_indexes or node.id in self.coverage_columns):
+        raise Exception, "ERROR unknown name in filter expression: {0} ; available: {1}".format(node.id, ' '.join( sorted(self.column_indexes.keys()+self.coverage_columns.keys()) ))
+      self.names.add(node.id)
+      name=node.id
+      return lambda values: values[name]
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id=='abs' and len(node.args)==1 and not node.keywords:
+      argument=self._compile(node.args[0])
+      return lambda values: numpy.abs( argument(values) )
+    raise Exception, "ERROR invalid filter expression: {0} ; only column names, numbers, comparisons, and/or/not, + - * / and abs() are allowed".format(self.expression)
+
+  def _missing_columns_error(self, n_columns):
+    return Exception( "ERROR the filter expression {0} requires {1} columns in the tabular blast output, but there are only {2}".format(self.expression, self.n_columns_needed, n_columns) )
+
+  def _values(self, column_values):
+    """ Adds the coverage values to a dictionary with the values of columns, and returns it """
+    for name, (start, end, length) in self.coverage_columns.iteritems():
+      if name in self.names:   column_values[name]=_divide( ( abs(column_values[end]-column_values[start])+1 )*100.0, column_values[length] )
+    return column_values
+
+  def accepts(self, fields):
+    """ Tests a single line of tabular blast output, split by tab. Returns True or False """
+    if len(fields)<self.n_columns_needed: raise self._missing_columns_error(len(fields))
+    values=self._values( dict( (name, m8_evalue(fields[10]) if name=='evalue' else float(fields[self.column_indexes[name]])) for name in self.column_names ) )
+    return bool( self.row_function( *[values[name] for name in self.names] ) )
+
+  def mask(self, fields, n_columns):
+    """ Tests a block of lines of tabular blast output, provided as a flat list of all their fields (n_columns for each line). Returns a numpy boolean array """
+    if numpy is None: raise Exception, "ERROR numpy is required to filter blocks of lines of tabular blast output!"
+    if n_columns<self.n_columns_needed: raise self._missing_columns_error(n_columns)
+    column_values={}
+    for name in self.column_names:
+      column=fields[ self.column_indexes[name]::n_columns ]
+      try:                column_values[name]=numpy.array(column).astype(numpy.float64)
+      except ValueError:  column_values[name]=numpy.array( map(m8_evalue, column), dtype=numpy.float64 )   # old evalue format, e.g. e-180
+    n_lines=len(fields)/n_columns
+    with numpy.errstate(invalid='ignore'):     # comparisons with nan (see _divide)
+      return numpy.logical_and( self.vector_function( self._values(column_values) ), numpy.ones(n_lines, dtype=bool) )   # also for constant expressions
+
+def m8_chunk_offsets(filename, n_chunks):
+  """ Splits a file in (at most) n_chunks byte ranges aligned to line starts. Returns a list like [ [start, end], ... ] """
+  fh=open(filename, 'rb');   fh.seek(0, 2);   file_size=fh.tell()
+  boundaries=[0]
+  for chunk_index in range(1, n_chunks):
+    fh.seek( max(boundaries[-1], file_size*chunk_index/n_chunks) )
+    if fh.tell()>0:   fh.readline()    #reaching next line start
+    boundaries.append( min(fh.tell(), file_size) )
+  fh.close()
+  boundaries.append(file_size)
+  return [ [start, end] for start, end in zip(boundaries[:-1], boundaries[1:]) if end>start ]
+
+def iterate_m8_lines(filename, start=0, end=None):
+  """ Generator of the lines of a tabular blast file starting within byte range [start, end), split by tab. Empty and comment lines are skipped.
+  Compressed files are accepted (see open_input), but only if reading them whole """
+  if not start and end is None:  fh=open_input(filename)
+  else:                          fh=open(filename, 'rb');   fh.seek(start)
+  position=start
+  for line in fh:
+    if end is not None and position>=end: break
+    position+=len(line)
+    if line[0] in '#\n': continue
+    yield line.rstrip('\r\n').split('\t')
+  fh.close()
+
+def filter_hits(hits, evalue_threshold, species_function=None, stats=None, extra_filter=None):
+  """ Generator of the hits passing the filters, yielded as tuples (subject, query, evalue, bitscore) in their order. hits is an iterable of raw tuples
+  (subject, query, evalue, bitscore), as read by a parser. Filters, in this order, are: evalue < evalue_threshold;  subject != query;  if species_function is provided,
+  species_function(subject) != species_function(query);  if extra_filter (a compound_filter) is provided, raw tuples have the split line as fifth item, which it must accept.
+  If a run_stats object is provided, the hits passing and those rejected by each filter are counted in it """
+  counts=None if stats is None else stats.counts
+  for hit in hits:
+    subject, query, evalue, bitscore = hit[:4]
+    if not evalue < evalue_threshold:
+      if counts is not None: counts['rejected_evalue']+=1
+      continue
+    if subject == query:
+      if counts is not None: counts['rejected_self_hit']+=1
+      continue
+    if species_function is not None and species_function(subject) == species_function(query):
+      if counts is not None: counts['rejected_same_species']+=1
+      continue
+    if extra_filter is not None and not extra_filter.accepts(hit[4]):
+      if counts is not None: counts['rejected_filter']+=1
+      continue
+    if counts is not None: counts['passed']+=1
+    yield subject, query, evalue, bitscore
+
+def iterate_m8_hits(filename, evalue_threshold, species_function=None, start=0, end=None, stats=None, extra_filter=None):
+  """ Generator of the hits in a tabular blast file (or in byte range [start, end) of it) which pass the filters, yielded as tuples (subject, query, evalue, bitscore).
+  Filters and stats are as in filter_hits; extra_filter (a compound_filter), if provided, must accept the line """
+  return filter_hits( ( (splt[1], splt[0], m8_evalue(splt[10]), float(splt[11]), splt) for splt in iterate_m8_lines(filename, start, end) ),
+                      evalue_threshold, species_function, stats, extra_filter )
+
+_chunk_worker_filters={}
+def _init_chunk_worker(evalue_threshold, species_function_string, with_stats, filter_expression):
+  _chunk_worker_filters['evalue_threshold']=evalue_threshold
+  _chunk_worker_filters['species_function']=None if species_function_string is None else cached_function( eval('lambda x:'+species_function_string) )
+  _chunk_worker_filters['with_stats']=with_stats
+  _chunk_worker_filters['extra_filter']=None if filter_expression is None else compound_filter(filter_expression)
+
+def _chunk_spanning_hits(args):
+  """ Worker function for parallel_m8_hits: parses and filters a chunk, and reduces it to the hits that change its local clustering.
+  Hits which join two ids already connected by previous hits of the same chunk are also redundant in the global clustering, so they are dropped.
+  Returns a tuple (hits, counts), where counts is the counts dictionary of a run_stats for this chunk, or None """
+  filename, start, end = args
+  clusters=single_link_clustering()
+  stats=run_stats() if _chunk_worker_filters['with_stats'] else None
+  hits=[ hit for hit in iterate_m8_hits(filename, _chunk_worker_filters['evalue_threshold'], _chunk_worker_filters['species_function'], start, end, stats, _chunk_worker_filters['extra_filter'])
+         if clusters.add_hit(hit[0], hit[1]) ]
+  return hits, (None if stats is None else stats.counts)
+
+def parallel_m8_hits(filename, n_cpus, evalue_threshold, species_function_string=None, chunks_per_cpu=4, stats=None, filter_expression=None):
+  """ Same as iterate_m8_hits, but the file is split in line-aligned chunks which are parsed, filtered and reduced by a pool of n_cpus processes.
+  The species function is provided as string (lambda style, as in option -sf of blast_homology_clusters.py) so that it can be built in each worker;
+  the same for the extra filter, whose expression is provided (see compound_filter).
+  Hits are yielded in file order, and only those redundant for single link clustering are omitted: feeding them to a single_link_clustering gives the same result as the serial parsing.
+  If a run_stats object is provided, the counts of the workers are added to it (hits passing the filters are counted even if redundant) """
+  from multiprocessing import Pool
+  if compression_format(filename): raise Exception, "ERROR compressed input files cannot be split in chunks for parallel parsing: {0}".format(filename)
+  chunks=m8_chunk_offsets(filename, n_cpus*chunks_per_cpu)
+  pool=Pool(n_cpus, _init_chunk_worker, (evalue_threshold, species_function_string, stats is not None, filter_expression))
+  try:
+    for hits, counts in pool.imap( _chunk_spanning_hits, [ (filename, start, end) for start, end in chunks ] ):
+      if stats is not None: stats.add_counts(counts)
+      for hit in hits:  yield hit
+    pool.close()
+  finally:
+    pool.terminate()
+
+def iterate_m8_blocks(filename, ids, evalue_threshold, species_function=None, with_bitscores=False, block_size=2**24, stats=None, extra_filter=None):
+  """ Columnar fast path to read a tabular blast file; requires numpy. The file is read in blocks of about block_size bytes, and only the
+  query, subject and evalue columns (and bitscore, if with_bitscores, and those used by extra_filter) are kept. Gene ids are interned in the id_table ids,
+  and filters (same as filter_hits) are applied as vectorized masks. The species function is computed only once per id. Compressed files are accepted (see open_input).
+  Generator of tuples (subject_indexes, query_indexes, evalues, bitscores), which are numpy arrays for the hits passing the filters, in file order.
+  bitscores is None unless with_bitscores is True. If a run_stats object is provided, hits are counted in it as in iterate_m8_hits, and the time
+  spent in filters (including the computation of species) is accounted to stage 'filter' """
+  if numpy is None: raise Exception, "ERROR numpy is required to use the columnar reader of tabular blast output!"
+  species_codes=numpy.zeros(0, dtype=numpy.int32);    species2code={}    # species code of each interned id
+  fh=open_input(filename)
+  while True:
+    block=fh.read(block_size)
+    if not block: break
+    block+=fh.readline()    # completing last line
+    if '#' in block or '\n\n' in block or block[0]=='\n':   block=''.join( line for line in block.splitlines(True) if line[0] not in '#\n' )
+    if not block.endswith('\n'):  block+='\n'
+    # counting tabs in each line: all lines must have as many as the first one
+    characters=numpy.frombuffer(block, dtype=numpy.uint8)
+    tabs_before_line_end=numpy.searchsorted( numpy.flatnonzero(characters==9), numpy.flatnonzero(characters==10) )
+    tabs_per_line=tabs_before_line_end - numpy.concatenate( ([0], tabs_before_line_end[:-1]) )
+    del characters
+    n_lines=len(tabs_per_line)
+    if (tabs_per_line!=tabs_per_line[0]).any():  raise Exception, "ERROR the tabular blast file {0} does not have the same number of columns in every line!".format(filename)
+    n_columns=int(tabs_per_line[0])+1
+    fields=block[:-1].replace('\n', '\t').split('\t')
+    try:                evalues=numpy.array(fields[10::n_columns]).astype(numpy.float64)
+    except ValueError:  evalues=numpy.array( map(m8_evalue, fields[10::n_columns]), dtype=numpy.float64 )
+    bitscores=numpy.array(fields[11::n_columns]).astype(numpy.float64) if with_bitscores else None
+    if stats is not None: stats.start('filter')
+    mask= evalues < evalue_threshold
+    if extra_filter is not None:  extra_mask=extra_filter.mask(fields, n_columns)
+    if stats is not None: stats.stop()
+    # factorizing ids: subjects and queries together
+    unique_ids, inverse = numpy.unique( numpy.array( fields[1::n_columns]+fields[0::n_columns] ), return_inverse=True )
+    del fields
+    unique_indexes=numpy.array( [ids.index(gid) for gid in unique_ids.tolist()], dtype=numpy.int64 )
+    all_indexes=unique_indexes[inverse]
+    subject_indexes, query_indexes = all_indexes[:n_lines], all_indexes[n_lines:]
+    if stats is not None:
+      stats.start('filter')
+      n_passed=int(mask.sum());  stats.counts['rejected_evalue']+=n_lines-n_passed
+    mask &= subject_indexes != query_indexes
+    if stats is not None:  n_previous, n_passed = n_passed, int(mask.sum());  stats.counts['rejected_self_hit']+=n_previous-n_passed
+    if species_function is not None:
+      new_codes=[ species2code.setdefault( species_function(ids[index]), len(species2code) ) for index in xrange(len(species_codes), len(ids)) ]
+      if new_codes:  species_codes=numpy.concatenate( (species_codes, numpy.array(new_codes, dtype=numpy.int32)) )
+      mask &= species_codes[subject_indexes] != species_codes[query_indexes]
+      if stats is not None:  n_previous, n_passed = n_passed, int(mask.sum());  stats.counts['rejected_same_species']+=n_previous-n_passed
+    if extra_filter is not None:
+      mask &= extra_mask
+      if stats is not None:  n_previous, n_passed = n_passed, int(mask.sum());  stats.counts['rejected_filter']+=n_previous-n_passed
+    if stats is not None:
+      stats.counts['passed']+=n_passed
+      stats.stop()
+    yield subject_indexes[mask], query_indexes[mask], evalues[mask], (None if bitscores is None else bitscores[mask])
+  fh.close()
+
+def top_hits_per_query(hits, n, by='evalue', reciprocal=False, stats=None):
+  """ Prunes hits, an iterable of tuples (subject, query, evalue, bitscore) such as yielded by iterate_m8_hits, keeping for each query only the hits to its
+  best n subjects: lowest evalue, or highest bitscore if by=='bitscore' (ties: first in input). If a subject has many hits (HSPs) with the same query, only
+  the best one is kept. If reciprocal is True, a hit is kept only if also the query is among the best n subjects of the subject (when this is a query).
+  Hits are consumed in one pass, keeping a heap of at most n entries per query; then the ones kept are yielded, in input order.
+  If a run_stats is provided, the hits removed are counted in it as pruned_top and pruned_reciprocity """
+  if not by in ('evalue', 'bitscore'): raise Exception, "ERROR hits can be ranked only by evalue or bitscore, not: {0}".format(by)
+  query2kept={}     # query -> (subject2entry, heap);  each entry is a list [key, -position, subject, hit]: the heap top is the worst one
+  position=-1
+  for position, hit in enumerate(hits):
+    subject, query = hit[0], hit[1]
+    key= -hit[2] if by=='evalue' else hit[3]
+    kept=query2kept.get(query)
+    if kept is None:  kept=query2kept[query]=({}, [])
+    subject2entry, heap = kept
+    entry=subject2entry.get(subject)
+    if not entry is None:    # another hit with this subject: keeping the best one
+      if key>entry[0]:
+        entry[0], entry[1], entry[3] = key, -position, hit
+        heapq.heapify(heap)
+    elif len(heap)<n:
+      entry=[key, -position, subject, hit];    heapq.heappush(heap, entry);   subject2entry[subject]=entry
+    elif key>heap[0][0]:
+      entry=[key, -position, subject, hit];    del subject2entry[ heapq.heapreplace(heap, entry)[2] ];   subject2entry[subject]=entry
+  entries=[ entry for subject2entry, heap in query2kept.itervalues() for entry in heap ]
+  n_kept=len(entries)
+  if reciprocal:
+    entries=[ entry for entry in entries if entry[3][0] in query2kept and entry[3][1] in query2kept[ entry[3][0] ][0] ]
+  if stats is not None:
+    stats.add_counts( {'pruned_top':position+1-n_kept, 'pruned_reciprocity':n_kept-len(entries)} )
+  del query2kept
+  entries.sort( key=lambda entry:-entry[1] )
+  for entry in entries:   yield entry[3]
+
+###############################################################################################
+###### hubs: promiscuous proteins (e.g. with common domains) which chain unrelated families together in single link clustering
+
+def parse_degree_cutoff(cutoff_string):
+  """ Parses a hub cutoff: a max number of distinct neighbours (e.g. '200') or a percentile of the degree distribution (e.g. '99.9%').
+  Returns a tuple (value, is_percentile). Raises ValueError if invalid """
+  cutoff_string=str(cutoff_string).strip()
+  if cutoff_string.endswith('%'):
+    value=float(cutoff_string[:-1])
+    if not 0<value<100: raise ValueError, cutoff_string
+    return value, True
+  value=int(cutoff_string)
+  if value<1: raise ValueError, cutoff_string
+  return value, False
+
+class hub_detector(object):
+  """ Finds hubs of the homology graph: ids with more distinct neighbours (degree) than a cutoff, provided as in parse_degree_cutoff. Requires numpy.
+  Hits (tuples as yielded by iterate_m8_hits) are passed through with filter(hits): they are consumed in one pass, keeping them in a hit_edges while ids
+  are interned, then degrees are counted (hits between the same two ids count once) and the hits are yielded in input order; if drop is True, those
+  involving a hub are left out, so that they never reach the union step. Dropped hubs do not appear in families. After that:
+    self.max_degree    ids with degree above this are hubs;      self.hubs   integer ids of the hubs, highest degree first
+    self.n_dropped     number of hits dropped
+  write_report(filename) writes hubs and the components they bridge, i.e. the clusters of their neighbours when hub hits are removed
+  Usage:   h=hub_detector('99.9%');   for hit in h.filter(hits): ...;    h.write_report('hubs.tsv') """
+  def __init__(self, cutoff, drop=True):
+    if numpy is None: raise Exception, "ERROR numpy is required to detect hubs!"
+    self.cutoff, self.is_percentile = parse_degree_cutoff(cutoff)
+    self.drop=drop
+    self.edges=hit_edges()
+    self.max_degree=None;  self.hubs=[];  self.n_dropped=0
+
+  def count_degrees(self):
+    """ Computes the degree of each id of the edges collected, and finds hubs. Returns the numpy array of degrees """
+    left, right = self.edges.columns()[:2]
+    low, high = numpy.minimum(left, right).astype(numpy.int64), numpy.maximum(left, right).astype(numpy.int64)
+    pairs=numpy.unique( (low<<32) | high )
+    self.low, self.high = pairs>>32, pairs & 0xffffffff
+    self.degree=numpy.bincount( numpy.concatenate( (self.low, self.high) ), minlength=len(self.edges.ids) )
+    if not self.is_percentile:  self.max_degree=self.cutoff
+    elif len(pairs):            self.max_degree=int( numpy.percentile(self.degree[self.degree>0], self.cutoff) )
+    else:                       self.max_degree=0
+    self.is_hub=self.degree>self.max_degree
+    hubs=numpy.flatnonzero(self.is_hub)
+    self.hubs=hubs[ numpy.argsort(-self.degree[hubs], kind='mergesort') ].tolist()
+    return self.degree
+
+  def filter(self, hits, stats=None):
+    """ Generator of hits, see the class description. If a run_stats is provided, dropped hits are counted in it as pruned_hub """
+    edges=self.edges
+    for id_left, id_right, evalue, bitscore in hits:   edges.add_hit(id_left, id_right, evalue, bitscore)
+    self.count_degrees()
+    ids=edges.ids;  is_hub=self.is_hub.tolist()
+    for index_left, index_right, evalue, bitscore in izip(edges.left, edges.right, edges.evalue, edges.bitscore):
+      if self.drop and (is_hub[index_left] or is_hub[index_right]):
+        self.n_dropped+=1
+        continue
+      yield ids[index_left], ids[index_right], evalue, bitscore
+    if stats is not None:
+      stats.add_counts( {'pruned_hub':self.n_dropped} )
+      stats.info['hubs']={ 'max_degree':self.max_degree, 'n_hubs':len(self.hubs), 'dropped':bool(self.drop) }
+
+  def bridged_components(self):
+    """ Generator of tuples (hub id, degree, component sizes) for each hub, highest degree first. Component sizes (largest first) are those of the
+    clusters which contain its neighbours, when all hits of hubs are removed (neighbours without other hits count as clusters of size 1; hubs are not counted) """
+    is_hub=self.is_hub
+    clusters=single_link_clustering(self.edges.ids)
+    keep=~( is_hub[self.low] | is_hub[self.high] )
+    clusters.add_links( self.low[keep].tolist(), self.high[keep].tolist() )
+    touching=~keep & (is_hub[self.low] != is_hub[self.high])     # hub to non-hub pairs
+    low, high = self.low[touching], self.high[touching]
+    low_is_hub=is_hub[low]
+    hub_column=numpy.where(low_is_hub, low, high);   neighbour_column=numpy.where(low_is_hub, high, low)
+    order=numpy.argsort(hub_column, kind='mergesort')
+    hub_column, neighbour_column = hub_column[order], neighbour_column[order]
+    starts=numpy.searchsorted(hub_column, self.hubs, side='left');   ends=numpy.searchsorted(hub_column, self.hubs, side='right')
+    ids=self.edges.ids;  size=clusters.size
+    for hub, start, end in izip(self.hubs, starts, ends):
+      root2size={}
+      for neighbour in neighbour_column[start:end].tolist():
+        if clusters.is_linked(neighbour):   root=clusters.find(neighbour);  root2size[root]=size[root]
+        else:                               root2size[-neighbour-1]=1
+      yield ids[hub], int(self.degree[hub]), sorted(root2size.values(), reverse=True)
+
+  def write_report(self, filename, max_sizes=20):
+    """ Writes a tab separated file with one line per hub (see bridged_components): id, degree, number of components bridged, total members of these
+    components, and the sizes of the largest max_sizes of them (comma separated) """
+    fh=open(filename, 'w')
+    print >> fh, '#max_degree={0}\thubs={1}\thits_dropped={2}'.format(self.max_degree, len(self.hubs), self.n_dropped)
+    print >> fh, '#id\tdegree\tcomponents\tmembers\tlargest_components'
+    for gid, degree, sizes in self.bridged_components():
+      print >> fh, '{0}\t{1}\t{2}\t{3}\t{4}'.format(gid, degree, len(sizes), sum(sizes), ','.join(map(str, sizes[:max_sizes])))
+    fh.close()
+
+
+###############################################################################################
+###### reading pairwise blast output (default format of blastall, and of blast+ with -outfmt 0)
+# only three kinds of lines matter:   Query= query_id description ;   >subject_id description ;    Score = 280 bits (716), Expect = 1e-75 (one per HSP)
+
+pairwise_line_pattern=re.compile(r'^(?:Query=[ \t]*(\S+)|>[ \t]*(\S+)|[ \t]*Score[ \t]*=[ \t]*(\S+)[ \t]+bits[^\n]*?Expect(?:\(\d+\))?[ \t]*=[ \t]*([^\s,]+))', re.M)
+
+def iterate_pairwise_hits(filename, evalue_threshold, species_function=None, stats=None, block_size=2**24):
+  """ Generator of the hits (HSPs) in a pairwise blast output file which pass the filters, yielded as tuples (subject, query, evalue, bitscore), in file order.
+  Filters and stats are as in iterate_m8_hits. The file is read in large blocks (compressed files are accepted, see open_input) which are scanned with a
+  regular expression for the lines with query, subject and score: alignment lines are skipped without being split or copied """
+  return filter_hits( _iterate_pairwise_raw_hits(filename, block_size), evalue_threshold, species_function, stats )
+
+def _iterate_pairwise_raw_hits(filename, block_size):
+  query, subject = None, None
+  fh=open_input(filename)
+  while True:
+    block=fh.read(block_size)
+    if not block: break
+    block+=fh.readline()    # completing last line
+    for match in pairwise_line_pattern.finditer(block):
+      query_match, subject_match, bitscore, evalue = match.groups()
+      if   query_match   is not None:   query, subject = query_match, None
+      elif subject_match is not None:   subject=subject_match
+      else:
+        if query is None or subject is None:  raise Exception, "ERROR parsing pairwise blast output {0}: score line found before query or subject: {1}".format(filename, match.group(0))
+        yield subject, query, m8_evalue(evalue), float(bitscore)
+  fh.close()
+
+###############################################################################################
+###### homology graph as sparse matrix: alternative clustering backends (require numpy and scipy)
+
+def _normalize_columns(matrix):
+  sums=numpy.asarray( matrix.sum(axis=0) ).ravel()
+  sums[sums==0]=1.0
+  return matrix.dot( sparse.diags(1.0/sums) ).tocsc()
+
+def mcl_labels(matrix, inflation=2.0, pruning=1e-4, max_iterations=100, tolerance=1e-6):
+  """ Markov clustering (MCL) of a symmetric sparse adjacency matrix. Self loops with the max weight of each column are added;
+  then expansion (matrix product) and inflation (elementwise power, then column normalization) are alternated until convergence.
+  Values below pruning are removed at every iteration to keep the matrix sparse.
+  Returns a numpy array with a cluster label for each node, which is the index of its attractor """
+  m=matrix.tocsc().astype(numpy.float64)
+  loops=numpy.asarray( m.max(axis=0).todense() ).ravel()
+  loops[loops==0]=1.0
+  m=_normalize_columns( m + sparse.diags(loops) )
+  for iteration in xrange(max_iterations):
+    previous=m
+    m=_normalize_columns( m.dot(m).power(inflation) )
+    m.data[ m.data < pruning ]=0.0;   m.eliminate_zeros()
+    m=_normalize_columns(m)
+    if not m.nnz or abs(m-previous).max() < tolerance: break
+  labels=numpy.asarray( m.argmax(axis=0) ).ravel()
+  empty_columns=numpy.flatnonzero( numpy.diff(m.indptr)==0 )
+  labels[empty_columns]=empty_columns     # emptied by pruning: left alone
+  return labels
+
+def sparse_families(edges, method='cc', weight='evalue', inflation=2.0, min_size=0):
+  """ Clusters the homology graph of a hit_edges object using sparse matrices. method can be:
+    cc    connected components (same families as single_link_clustering, but members are sorted as below)
+    mcl   markov clustering, see mcl_labels; weight (evalue or bitscore) and inflation are used only in this case
+  Returns a list of families, each one a list of gene ids. Members are sorted by their index in edges.ids, i.e. in the order ids were interned: this is their
+  order of first appearance with line by line readers, but not with iterate_m8_blocks, which interns the ids of each block in sorted order.
+  Largest families first, ties by index of their first member; those with less than min_size members are omitted """
+  if numpy is None or sparse is None: raise Exception, "ERROR numpy and scipy are required to use the sparse matrix clustering backends!"
+  if not len(edges): return []
+  nodes, matrix = edges.adjacency_matrix(weight)
+  if   method=='cc':
+    from scipy.sparse import csgraph
+    n_components, labels = csgraph.connected_components(matrix, directed=False)
+  elif method=='mcl':    labels=mcl_labels(matrix, inflation=inflation)
+  else:  raise Exception, "ERROR unknown sparse clustering method: {0} ; use cc or mcl".format(method)
+  order=numpy.lexsort( (nodes, labels) )   # grouping by label; within each, by id
+  groups=numpy.split( nodes[order], numpy.flatnonzero( numpy.diff(labels[order]) )+1 )
+  groups.sort( key=lambda g:(-len(g), g[0]) )
+  ids=edges.ids
+  return [ [ids[i] for i in g.tolist()] for g in groups if len(g)>=min_size ]
+
+
+###############################################################################################
+###### instrumentation of runs
+
+class run_stats(object):
+  """ Collects statistics of a clustering run, to be written as json with write_json. Contains:
+    stage times    seconds spent in each stage, accumulated with start(stage) and stop(). Stages can be nested: the time of the inner stage
+                   is not accounted to the outer one (e.g. 'filter' inside 'parse', for readers which time filters separately)
+    counts         counters of hits: passed, rejected_evalue, rejected_self_hit, rejected_same_species, rejected_filter (filled by the m8 readers), plus any other key
+    snapshots      list of [elapsed seconds, hits read, largest cluster, n clusters] taken with snapshot(clusters) during the run
+  Usage:   s=run_stats();   s.start('parse');  ...;  s.stop();   s.write_json('stats.json')  """
+  hit_count_keys=['passed', 'rejected_evalue', 'rejected_self_hit', 'rejected_same_species', 'rejected_filter']
+  def __init__(self):
+    self.start_time=time.time()
+    self.stage_times={};  self.stage_order=[]
+    self.stage_stack=[];  self.stage_start=None
+    self.counts=dict( (k, 0) for k in self.hit_count_keys )
+    self.snapshots=[]
+    self.info={}
+
+  def _account(self, stage, now):
+    if not stage in self.stage_times:  self.stage_times[stage]=0.0;  self.stage_order.append(stage)
+    self.stage_times[stage]+=now-self.stage_start
+
+  def start(self, stage):
+    """ Starts (or resumes) timing stage; the stage currently running, if any, is paused until the matching stop() """
+    now=time.time()
+    if self.stage_stack: self._account(self.stage_stack[-1], now)
+    self.stage_stack.append(stage);   self.stage_start=now
+
+  def stop(self):
+    """ Stops timing the last started stage, and resumes the one which was running before it, if any """
+    now=time.time()
+    self._account(self.stage_stack.pop(), now)
+    self.stage_start=now
+
+  def timed_batches(self, iterable, stage, batch_size=65536):
+    """ Generator of lists of (up to) batch_size items of iterable. The time spent producing them is accounted to stage.
+    Used to time separately the reading of hits (a generator) and what is done with them, without timing every single hit """
+    iterator=iter(iterable)
+    while True:
+      self.start(stage)
+      batch=list( islice(iterator, batch_size) )
+      self.stop()
+      if not batch: break
+      yield batch
+
+  def add_counts(self, counts):
+    for k, value in counts.iteritems():  self.counts[k]=self.counts.get(k, 0)+value
+
+  def hits_read(self):
+    """ Number of hits read so far, i.e. those passing the filters plus those rejected """
+    return sum( self.counts[k] for k in self.hit_count_keys )
+
+  def elapsed(self):  return time.time()-self.start_time
+
+  def snapshot(self, clusters=None):
+    """ Records the current time, hits read and, if a single_link_clustering is provided, its largest cluster and number of clusters """
+    self.snapshots.append( [ round(self.elapsed(), 3), self.hits_read(),
+                             None if clusters is None else clusters.largest, None if clusters is None else clusters.n_clusters() ] )
+
+  def progress_line(self):
+    """ One line summary of the run so far, for progress reports """
+    elapsed=self.elapsed()
+    out='{0:.1f}s  hits read: {1}  ({2:.0f}/s)'.format(elapsed, self.hits_read(), self.hits_read()/elapsed if elapsed else 0.0)
+    if self.snapshots and self.snapshots[-1][2] is not None: out+='  largest cluster: {0[2]}  clusters: {0[3]}'.format(self.snapshots[-1])
+    return out
+
+  def peak_memory(self):
+    """ Returns a dictionary with the peak resident memory (MB) of this process and of its (finished) child processes, e.g. parallel parsing workers """
+    unit=1024.0 if os.uname()[0]!='Darwin' else 1024.0*1024   # ru_maxrss is in kilobytes on linux, bytes on mac os
+    return { 'self':     round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/unit, 1),
+             'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/unit, 1) }
+
+  def summary(self, clusters=None):
+    """ Returns all statistics as a dictionary (json serializable). If a single_link_clustering is provided, its merge counters are included """
+    elapsed=self.elapsed()
+    read_time=sum( self.stage_times.get(stage, 0.0) for stage in ('parse', 'filter') )
+    out={ 'wall_time': round(elapsed, 3),
+          'stages':    [ [stage, round(self.stage_times[stage], 3)] for stage in self.stage_order ],
+          'hits':      { 'read': self.hits_read(), 'passed': self.counts['passed'],
+                         'rejected': dict( (k[len('rejected_'):], self.counts[k]) for k in self.hit_count_keys if k.startswith('rejected_') ),
+                         'per_second_overall': round(self.hits_read()/elapsed, 1) if elapsed else None,
+                         'per_second_reading': round(self.hits_read()/read_time, 1) if read_time else None },
+          'other_counts': dict( (k, value) for k, value in self.counts.iteritems() if not k in self.hit_count_keys ),
+          'largest_cluster_over_time': { 'columns': ['seconds', 'hits_read', 'largest_cluster', 'n_clusters'], 'values': self.snapshots },
+          'peak_memory_mb': self.peak_memory() }
+    if clusters is not None:
+      out['clustering']={ 'ids': len(clusters.ids), 'clusters': clusters.n_clusters(), 'clusters_created': clusters.cluster_index-1,
+                          'merges': clusters.n_merges, 'members_moved': clusters.n_moved, 'largest_cluster': clusters.largest }
+    out.update(self.info)
+    return out
+
+  def write_json(self, filename, clusters=None):
+    """ Writes the summary (see summary) in json format to filename """
+    fh=open(filename, 'w')
+    json.dump( self.summary(clusters), fh, indent=1, sort_keys=True )
+    fh.write('\n')
+    fh.close()
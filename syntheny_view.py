@@ -9,8 +9,14 @@ import traceback
 sys.path.append('/home/mmariotti/scripts')
 from MMlib import *
 from tree_classes import syntheny_view
+from homology_classes import family_index, is_family_index, m8_chunk_offsets, open_input, compression_format
 from ete2 import Tree, TreeStyle, NodeStyle, faces
-import random
+import random, heapq, multiprocessing, re, hashlib
+from array import array
+import numpy
+from bisect import bisect_left
+from itertools import islice, ifilter, chain
+from collections import defaultdict
 
 help_msg="""Program to show a graphical representation based on ETE2 of the syntheny around some genes of interest. Each gene is represented as a colored arrow.
 Usage:  $ syntheny_view.py  -i genes.gff -a annotation.gff -f homology.tsv  [options]  
@@ -19,11 +25,15 @@ Usage:  $ syntheny_view.py  -i genes.gff -a annotation.gff -f homology.tsv  [opt
 -i      gff annotation file of genes of interest 
 -a      global gff annotation file. Genes overlapping with those of interest will be removed
 -f      homology tab separated file (i.e. lines like "geneId -tab- familyId"); to obtain one, run a all-against-all blastp and then run blast_homology_clusters.py 
+        The binary index written by blast_homology_clusters.py -AI is also accepted: only the genes displayed are looked up, for a much faster start-up
 
 ## processing input options
 -if     function to apply to each line of the -i file to determine the gene id. Default: first word of last field -- i.e. -if "x.split('\t').split()[0]" 
 -af     same as -if, but for the -a file. 
+        Shortcuts (faster, as the default): Name or ID for the value of this attribute in the last field (lines without it are skipped), word for the first word of the last field
 -at     tag (element type, third tab field) of the lines that will be kept from the -a file. Default: "gene";  use "*" to keep every element
+-fa     load the full -a file. By default, only the genes overlapping the regions that can be displayed are loaded: within -l of genes of interest,
+        or (with -n) in their chromosomes; genes overlapping them are also loaded, to remove overlaps as with the full file. Statistics on families found in the annotation refer to the genes loaded
 
 ## gene windows options
 -l      length of nts on either side of each gene of interest to be displayed
@@ -33,6 +43,8 @@ Usage:  $ syntheny_view.py  -i genes.gff -a annotation.gff -f homology.tsv  [opt
 -c      file with available colors. File with a single word per line, each identified as color in ete2/Qt4 (e.g. "#4567A1", "turquoise"). These colors are used as many times as necessary to draw all families
 -cr     color rotation scheme; defines how to use the available colors. Arg must be a number between 0 and 3, referring cumulatively to [0:fill, 1:outline, 2:box_bkg, 3:box_outline]. Example, with a value of 1 (default), colors are used for the fill and the outline only, while the boxes are kept always transparent. Use a higher -cr when in need to represent many families
 -rc     randomize the colors in the -c file
+-hc     hash colors: the colors of each family are chosen by hashing its id, so that the same family gets the same colors in different runs (with the
+        same -c and -cr), without passing -cf files around. Overrides -rc
 -cs     color for singlets, i.e. genes without a family assigned, or those being the only representatives for their family in the current run. Arg accepted: like -ci. Grey-like colors are suggested. Default: "gainsboro,darkgrey"
 -cf     color-per-family file. First word of each line must be a familyId, present in the input homology tsv file (or, a geneId). The next words (at least one must be present) are taken respectively as fill color, outline color, box background color, box outline color. This option overrides the colors that would be chosen with options -c and -cr. You can provide even just a subset of all families, with the rest being drawn according to -c and -cr
 -ci     color of genes of interest. You can provide a single value (fill) or comma separated values (max 4), which are interpreted as fill, outline, box background and box outline. This option has priority on all other color options. You should use colors that are not among the available colors provided with -c. Default: "white,royalblue". 
@@ -55,6 +67,7 @@ Usage:  $ syntheny_view.py  -i genes.gff -a annotation.gff -f homology.tsv  [opt
 -ocg     color per gene output; one line per gene in current view, like "geneId color_bkg color_outline box_bkg box_outline" (with tabs), using "None" for undefined colors  
 
 ## miscellaneous
+-cpu            number of processes used to parse the -a file (split in chunks) and to find overlapping genes (each chromosome and strand is processed separately)
 -out            instead of opening the interactive ete2 environment (default), create this output file (pdf or png extensions are accepted in the arg)
 -temp           temporary folder; a subfolder is created here and deleted upon exiting
 -legend         suppress normal input and output. Provide a file with lines like "left_id -tab- color_bkg color_outline box_bkg box_outline -tab- arrow_text -tab- desc_text". This will build a legend-like representation with one arrow per line colored as specified (you can use None as color), some text inside the arrow, and some next to it. Strings "\n" will be interpreted as newline characters.
@@ -66,8 +79,8 @@ command_line_synonyms={}
 
 def_opt= { 'temp':'/home/mmariotti/temp', 
 'i':'',   'a':'',  'f':'',
-'if':None,    'af':"x.split('\t')[-1].split(';Name=')[-1].split(';')[0]",     'at':'gene',
-'c':'/home/mmariotti/libraries/available_colors.tab', 'cr':1,  'cf':0,  'ci': 'white,royalblue', 'cs':'gainsboro,darkgrey', 'rc':0,
+'if':None,    'af':"x.split('\t')[-1].split(';Name=')[-1].split(';')[0]",     'at':'gene',   'fa':0,
+'c':'/home/mmariotti/libraries/available_colors.tab', 'cr':1,  'cf':0,  'ci': 'white,royalblue', 'cs':'gainsboro,darkgrey', 'rc':0, 'hc':0,
 'l':10000, 'n':0,
 'fs':8, 'w':120,
 'm':0, 
@@ -75,6 +88,7 @@ def_opt= { 'temp':'/home/mmariotti/temp',
 'of':0, 'oc':0, 'ocf':0, 'ocg':0,
 'v':0, 'out':0,
 'legend':0,
+'cpu':1,
 }
 
 #########################################################
@@ -83,7 +97,396 @@ def_opt= { 'temp':'/home/mmariotti/temp',
 class gene_cluster(list):
   """ Simple class to add  a single attribute to a list of genes, which is: the central gene of interest used to populate this list (.ref_gene)"""
   def link_to_gene(self, g):     self.ref_gene=g
-  
+
+class gene_table(object):
+  """ Columnar store of genes, so that MMlib gene objects are not needed for every annotated gene: they are built (and cached) with gene_object(i) only
+  for the genes displayed. Gene i has id self.ids[i], and values in numpy arrays:
+    chromosome   index in self.chromosome_names          strand     index in self.strand_names
+    start, end   boundaries of the gene (of all exons)   length     sum of the lengths of exons, as gene.length()
+    interest     rank of gene of interest (1-based), 0 for others
+    family       index in self.families of the family of the gene, -1 if none (see set_families)
+  Exons are in CSR layout: those of gene i are in exon_starts and exon_ends from exon_offsets[i] to exon_offsets[i+1] (excluded), in order of addition.
+  The constructor takes per-gene lists/arrays, and per-exon arrays with the index of their gene (exon_gene), in any order. objects is an optional
+  dictionary index -> gene object, used by gene_object (e.g. to return the same objects loaded for genes of interest) """
+  def __init__(self, ids, chromosome_names, chromosome, strand_names, strand, exon_gene, exon_starts, exon_ends, interest=None, objects=None):
+    n=len(ids)
+    self.ids=ids;  self.chromosome_names=chromosome_names;  self.strand_names=strand_names
+    self.chromosome=numpy.asarray(chromosome, dtype=numpy.int32);   self.strand=numpy.asarray(strand, dtype=numpy.int8)
+    self.interest=numpy.zeros(n, dtype=numpy.int32) if interest is None else numpy.asarray(interest, dtype=numpy.int32)
+    exon_gene=numpy.asarray(exon_gene, dtype=numpy.int32)
+    order=numpy.argsort(exon_gene, kind='mergesort')      # exons grouped by gene, keeping their order
+    self.exon_starts=numpy.asarray(exon_starts, dtype=numpy.int64)[order];   self.exon_ends=numpy.asarray(exon_ends, dtype=numpy.int64)[order]
+    self.exon_offsets=numpy.zeros(n+1, dtype=numpy.int64);   self.exon_offsets[1:]=numpy.cumsum( numpy.bincount(exon_gene, minlength=n) )
+    if n:
+      self.start=numpy.minimum.reduceat(self.exon_starts, self.exon_offsets[:-1]);   self.end=numpy.maximum.reduceat(self.exon_ends, self.exon_offsets[:-1])
+      self.length=numpy.add.reduceat(self.exon_ends-self.exon_starts+1, self.exon_offsets[:-1])
+    else:  self.start, self.end, self.length = [numpy.zeros(0, dtype=numpy.int64) for i in range(3)]
+    self.families=[];  self.family=-numpy.ones(n, dtype=numpy.int32)
+    self.objects={} if objects is None else objects
+
+  def __len__(self):  return len(self.ids)
+
+  def exon_gene(self):
+    """ Returns the array with the index of the gene of each exon """
+    return numpy.repeat( numpy.arange(len(self), dtype=numpy.int32), numpy.diff(self.exon_offsets) )
+
+  def gene_object(self, i):
+    """ Returns the MMlib gene object for gene i, built the first time it is requested. It has attribute is_of_interest (rank, or False) """
+    i=int(i)
+    if not i in self.objects:
+      g=gene( chromosome=self.chromosome_names[self.chromosome[i]], strand=self.strand_names[self.strand[i]] );   g.id=self.ids[i]
+      for k in xrange(self.exon_offsets[i], self.exon_offsets[i+1]):  g.add_exon( int(self.exon_starts[k]), int(self.exon_ends[k]) )
+      g.is_of_interest=int(self.interest[i]) or False
+      self.objects[i]=g
+    return self.objects[i]
+
+  def gene_objects(self):  return [self.gene_object(i) for i in xrange(len(self))]
+
+  def subset(self, indexes):
+    """ Returns a new gene_table with the genes at these indexes (sorted array), in this order """
+    indexes=numpy.asarray(indexes, dtype=numpy.int64)
+    new_index=-numpy.ones(len(self), dtype=numpy.int64);   new_index[indexes]=numpy.arange(len(indexes))
+    exon_gene=new_index[ self.exon_gene() ];   kept_exons=exon_gene>=0
+    objects=dict( (int(new_index[i]), g) for i, g in self.objects.iteritems() if new_index[i]>=0 )
+    return gene_table( [self.ids[i] for i in indexes], self.chromosome_names, self.chromosome[indexes], self.strand_names, self.strand[indexes],
+                       exon_gene[kept_exons], self.exon_starts[kept_exons], self.exon_ends[kept_exons], self.interest[indexes], objects )
+
+  def overlapping_genes(self, selected):
+    """ Returns a boolean array, True for the genes whose span (start to end) overlaps that of some selected gene (boolean array) on the same chromosome """
+    if not selected.any():  return numpy.zeros(len(self), dtype=bool)
+    starts=( self.chromosome.astype(numpy.int64)<<40 )+self.start;   ends=( self.chromosome.astype(numpy.int64)<<40 )+self.end    # chromosomes made disjoint
+    chosen=numpy.flatnonzero(selected);   order=numpy.argsort(starts[chosen], kind='mergesort')
+    chosen_starts=starts[chosen][order];   max_ends=numpy.maximum.accumulate( ends[chosen][order] )
+    position=numpy.searchsorted(chosen_starts, ends, side='right')-1       # last selected gene starting before the end of each gene
+    return (position>=0) & ( max_ends[ numpy.maximum(position, 0) ]>=starts )
+
+  def in_regions(self, regions):
+    """ Returns a boolean array, True for the genes whose span (start to end) overlaps the regions provided (see target_regions) """
+    result=numpy.zeros(len(self), dtype=bool)
+    order=numpy.argsort(self.chromosome, kind='mergesort');   bounds=numpy.searchsorted(self.chromosome[order], numpy.arange(len(self.chromosome_names)+1))
+    for code, chromosome_name in enumerate(self.chromosome_names):
+      if not chromosome_name in regions: continue
+      on_chromosome=order[ bounds[code]:bounds[code+1] ];   starts, ends = regions[chromosome_name]
+      if starts is None:  result[on_chromosome]=True;  continue
+      region_index=numpy.searchsorted(starts, self.end[on_chromosome], side='right')-1       # last region starting before the end of each gene
+      result[on_chromosome]=(region_index>=0) & ( numpy.asarray(ends)[ numpy.maximum(region_index, 0) ]>=self.start[on_chromosome] )
+    return result
+
+  def set_families(self, geneid2family):
+    """ Fills self.family and self.families, looking up each gene id in geneid2family (a dictionary) """
+    family2index={}
+    for i, gid in enumerate(self.ids):
+      if gid in geneid2family:
+        family=geneid2family[gid]
+        if not family in family2index:  family2index[family]=len(self.families);  self.families.append(family)
+        self.family[i]=family2index[family]
+
+  def sorted_indexes(self, indexes=None):
+    """ Returns the array of gene indexes (all, or those provided) sorted by chromosome name and start; ties keep the order of indexes """
+    if indexes is None: indexes=numpy.arange(len(self))
+    name_rank=numpy.zeros(len(self.chromosome_names), dtype=numpy.int32)
+    name_rank[ sorted( range(len(self.chromosome_names)), key=self.chromosome_names.__getitem__ ) ]=numpy.arange(len(self.chromosome_names))
+    return indexes[ numpy.lexsort( (self.start[indexes], name_rank[ self.chromosome[indexes] ]) ) ]
+
+def _intern(names, name2code, name):
+  """ Returns the code of name in list names (and dictionary name2code), adding it if new """
+  if not name in name2code:  name2code[name]=len(names);  names.append(name)
+  return name2code[name]
+
+def gene_table_from_genes(genes, interest=False):
+  """ Builds a gene_table from MMlib gene objects (kept in the table, see gene_object). If interest is True, genes get interest ranks 1, 2, 3 ... in order """
+  chromosome_names=[];  chromosome2code={};   strand_names=[];  strand2code={}
+  chromosome=[ _intern(chromosome_names, chromosome2code, g.chromosome) for g in genes ];    strand=[ _intern(strand_names, strand2code, g.strand) for g in genes ]
+  exon_gene=[ i for i, g in enumerate(genes) for exon in g.exons ]
+  return gene_table( [g.id for g in genes], chromosome_names, chromosome, strand_names, strand,
+                     exon_gene, [exon[0] for g in genes for exon in g.exons], [exon[1] for g in genes for exon in g.exons],
+                     numpy.arange(1, len(genes)+1) if interest else None, dict(enumerate(genes)) )
+
+def concatenate_gene_tables(tables):
+  """ Returns a gene_table with the genes of all tables, in order: genes of the second table follow those of the first, and so on """
+  chromosome_names=[];  chromosome2code={};   strand_names=[];  strand2code={}
+  ids=[];  chromosome=[];  strand=[];  exon_gene=[];  exon_starts=[];  exon_ends=[];  interest=[];  objects={}
+  for t in tables:
+    offset=len(ids)
+    ids.extend(t.ids)
+    chromosome.append( numpy.array( [_intern(chromosome_names, chromosome2code, name) for name in t.chromosome_names]+[0], dtype=numpy.int32 )[t.chromosome] )
+    strand.append(     numpy.array( [_intern(strand_names, strand2code, name) for name in t.strand_names]+[0], dtype=numpy.int8 )[t.strand] )
+    exon_gene.append( t.exon_gene()+offset );   exon_starts.append(t.exon_starts);   exon_ends.append(t.exon_ends);   interest.append(t.interest)
+    for i, g in t.objects.iteritems():  objects[i+offset]=g
+  join_arrays=lambda arrays, dtype: numpy.concatenate(arrays) if arrays else numpy.zeros(0, dtype=dtype)
+  return gene_table( ids, chromosome_names, join_arrays(chromosome, numpy.int32), strand_names, join_arrays(strand, numpy.int8),
+                     join_arrays(exon_gene, numpy.int32), join_arrays(exon_starts, numpy.int64), join_arrays(exon_ends, numpy.int64), join_arrays(interest, numpy.int32), objects )
+
+class gene_interval_index(object):
+  """ Index of genes of a gene_table, to build the windows around genes of interest with logarithmic lookups. The genes indexed are provided as array of
+  indexes sorted by chromosome and start (see gene_table.sorted_indexes); windows are returned as positions in this array. A max-tree over the ends is kept,
+  since genes may be nested (e.g. inside the intron of a longer gene), so ends are not sorted.
+  Usage:   idx=gene_interval_index(table, indexes);   idx.distance_window(position, 10000)   or   idx.positions_before(position) , idx.positions_after(position) """
+  def __init__(self, table, indexes):
+    n=len(indexes)
+    chromosome=table.chromosome[indexes];   self.starts=table.start[indexes];   ends=table.end[indexes]
+    bounds=numpy.concatenate( ([0], numpy.flatnonzero(chromosome[1:]!=chromosome[:-1])+1, [n]) )
+    self.chromosome_first=numpy.repeat(bounds[:-1], numpy.diff(bounds)).tolist()    # for each position, the first and last+1 position of its chromosome
+    self.chromosome_last=numpy.repeat(bounds[1:], numpy.diff(bounds)).tolist()
+    size=1
+    while size<n: size*=2
+    end_tree=numpy.empty(2*size, dtype=numpy.int64);   end_tree.fill( numpy.iinfo(numpy.int64).min );   end_tree[size:size+n]=ends
+    level=size       # node k has children 2k and 2k+1; leaves start at size
+    while level>1:
+      end_tree[level/2:level]=numpy.maximum(end_tree[level:2*level:2], end_tree[level+1:2*level:2]);   level/=2
+    self.end_tree=end_tree.tolist();   self.size=size
+
+  def _reaching(self, first, before, min_end):
+    """ Returns the positions from first to before (excluded) whose gene ends at min_end or later, in increasing order. Subtrees whose max end is lower are skipped """
+    end_tree=self.end_tree;  size=self.size
+    out=[];  stack=[(1, 0, size)]
+    while stack:
+      node, node_start, node_end = stack.pop()
+      if node_start>=before or node_end<=first or end_tree[node]<min_end: continue
+      if node>=size: out.append(node-size);  continue
+      middle=(node_start+node_end)/2
+      stack.append( (2*node+1, middle, node_end) );   stack.append( (2*node, node_start, middle) )
+    return out
+
+  def distance_window(self, position, max_distance):
+    """ Returns the positions of the genes of the same chromosome overlapping the region from max_distance before the start of the gene at position
+    to max_distance after its end (position included), sorted. Genes nested in it, or containing it, are included """
+    first, last = self.chromosome_first[position], self.chromosome_last[position]
+    before=self._reaching(first, position, int(self.starts[position])-max_distance)
+    after_end=position+1+int( numpy.searchsorted(self.starts[position+1:last], self.end_tree[self.size+position]+max_distance, side='right') )
+    return before+range(position, after_end)
+
+  def positions_before(self, position):
+    """ Generator of the positions of the genes of the same chromosome sorted before position, closest first """
+    return xrange(position-1, self.chromosome_first[position]-1, -1)
+
+  def positions_after(self, position):
+    """ Generator of the positions of the genes of the same chromosome sorted after position, closest first """
+    return xrange(position+1, self.chromosome_last[position])
+
+def target_regions(genes, span=None):
+  """ Returns the regions where genes can be displayed around the genes provided, as dictionary chromosome -> (starts, ends): sorted lists with the
+  boundaries of disjoint regions, obtained merging the spans of span nts around each gene. If span is None, whole chromosomes are returned, as (None, None) """
+  chromosome2intervals={}
+  for g in genes:
+    if not g.chromosome in chromosome2intervals: chromosome2intervals[g.chromosome]=[]
+    start, end = g.boundaries()
+    chromosome2intervals[g.chromosome].append( (start-span, end+span) if not span is None else None )
+  regions={}
+  for chromosome, intervals in chromosome2intervals.iteritems():
+    if span is None:  regions[chromosome]=(None, None);  continue
+    starts=[];  ends=[]
+    for start, end in sorted(intervals):
+      if ends and start<=ends[-1]:  ends[-1]=max(ends[-1], end)
+      else:                         starts.append(start);  ends.append(end)
+    regions[chromosome]=(starts, ends)
+  return regions
+
+gff_id_shortcuts={   # precompiled equivalents of common expressions of -if/-af, and shortcuts: they do not split the whole line
+  "x.split('\\t')[-1].split(';Name=')[-1].split(';')[0]":   lambda x: x[x.rfind('\t')+1:].rpartition(';Name=')[2].partition(';')[0],
+  "x.split('\\t')[-1].split()[0]":                          lambda x: x[x.rfind('\t')+1:].split(None, 1)[0],
+  'word':                                                   lambda x: x[x.rfind('\t')+1:].split(None, 1)[0] }
+def _gff_attribute_getter(attribute):
+  pattern=re.compile(r'(?:(?<=\t)|(?<=;))[ ]*'+re.escape(attribute)+r'=([^;\t]*)')
+  def get_id(x):
+    match=pattern.search(x, x.rfind('\t'))
+    if match: return match.group(1)
+  return get_id
+for attribute in ('Name', 'ID'):  gff_id_shortcuts[attribute]=_gff_attribute_getter(attribute)
+for function_string in gff_id_shortcuts.keys():  gff_id_shortcuts[ function_string.replace('\\t', '\t') ]=gff_id_shortcuts[function_string]   #expressions with a real tab, as the default of -af
+
+def gff_id_function(function_string):
+  """ Returns the function to get the gene id out of a gff line (without newline), given as in options -if and -af: a python expression on x, or a shortcut:
+  Name or ID (value of this attribute in the last field; lines without it are skipped), word (first word of the last field) """
+  if function_string in gff_id_shortcuts: return gff_id_shortcuts[function_string]
+  return eval('lambda x:'+function_string)
+
+_gff_load_args=None   # (gff_file, tag, get_id, regions); set by load_gff_genes before forking its workers, so that get_id is not pickled
+
+def _parse_gff_lines(lines):
+  """ Parses gff lines with the arguments in _gff_load_args. Returns a list of tuples (id, chromosome, strand, start, end) for the lines of the right tag,
+  in order. Only the fields needed are looked at, and lines of chromosomes without regions (if these are given) are skipped before anything else """
+  gff_file, tag, get_id, regions = _gff_load_args
+  records=[];  tag_field='\t'+tag+'\t'
+  for line in lines:
+    if line[0] in '#\n' or (tag!='*' and not tag_field in line): continue
+    splt=line.split('\t', 3)
+    if len(splt)<4: continue
+    chromosome, source, line_tag, rest = splt
+    if not regions is None and not chromosome in regions: continue
+    if tag!='*' and line_tag!=tag: continue
+    line=line.rstrip('\r\n')
+    gid=get_id(line)
+    if gid is None: continue
+    splt=rest.split('\t', 4)
+    records.append( (gid, chromosome, splt[3], int(splt[0]), int(splt[1])) )
+  return records
+
+def _parse_gff_range(byte_range):
+  """ Parses the lines starting within byte range [start, end) of the gff file of _gff_load_args (see _parse_gff_lines) """
+  start, end = byte_range
+  fh=open(_gff_load_args[0], 'rb');  fh.seek(start)
+  def lines():
+    position=start
+    for line in fh:
+      if position>=end: break
+      position+=len(line)
+      yield line
+  records=_parse_gff_lines( lines() )
+  fh.close()
+  return records
+
+def load_gff_genes(gff_file, tag='*', get_id=None, regions=None, n_cpus=1, chunks_per_cpu=4):
+  """ Fast replacement of MMlib load_all_genes, returning a gene_table. Genes are identified by get_id on each line (see gff_id_function) and are in order
+  of first appearance, with an exon for each line of the right tag (third field; '*' for any). If regions are provided (see target_regions), only the genes
+  whose span (first to last line) overlaps them are kept, complete, plus those overlapping them (recursively). The file is split in line-aligned byte ranges parsed by a pool of n_cpus processes
+  (compressed files are parsed serially); exons are grouped per gene afterwards """
+  global _gff_load_args
+  _gff_load_args=(gff_file, tag, get_id, regions)
+  if n_cpus>1 and not compression_format(gff_file):
+    pool=multiprocessing.Pool(n_cpus)
+    results=pool.imap( _parse_gff_range, m8_chunk_offsets(gff_file, n_cpus*chunks_per_cpu) )
+  else:
+    pool=None;  fh=open_input(gff_file)
+    results=[ _parse_gff_lines(fh) ]
+  ids=[];  id2index={};  chromosome_names=[];  chromosome2code={};  strand_names=[];  strand2code={}
+  chromosome=array('i');  strand=array('b');  exon_gene=array('i');  exon_starts=array('l');  exon_ends=array('l')
+  for records in results:
+    for gid, chromosome_name, strand_name, start, end in records:
+      index=id2index.get(gid)
+      if index is None:
+        index=id2index[gid]=len(ids);  ids.append(gid)
+        chromosome.append( _intern(chromosome_names, chromosome2code, chromosome_name) );  strand.append( _intern(strand_names, strand2code, strand_name) )
+      exon_gene.append(index);  exon_starts.append(start);  exon_ends.append(end)
+  if pool is None:  fh.close()
+  else:             pool.close();  pool.join()
+  _gff_load_args=None
+  del id2index
+  table=gene_table( ids, chromosome_names, numpy.frombuffer(chromosome, dtype=numpy.int32), strand_names, numpy.frombuffer(strand, dtype=numpy.int8),
+                    numpy.frombuffer(exon_gene, dtype=numpy.int32), numpy.frombuffer(exon_starts, dtype='i{0}'.format(exon_starts.itemsize)), numpy.frombuffer(exon_ends, dtype='i{0}'.format(exon_ends.itemsize)) )
+  if not regions is None:
+    ## genes overlapping those kept are kept too, so that overlaps are resolved as with the full file; they may overlap others in turn
+    kept=table.in_regions(regions)
+    while True:
+      added=table.overlapping_genes(kept) & ~kept
+      if not added.any(): break
+      kept|=added
+    table=table.subset( numpy.flatnonzero(kept) )
+  return table
+
+_overlap_args=None   # (table, order, groups, scores, phase); set by resolve_overlaps before forking its workers, so that the table is never pickled
+
+def _gene_frames(table, i):
+  """ Returns the exons of gene i of table sorted by start, as tuples (start, end, frame): frame is the position in the coding sequence (modulo 3) of
+  the first nucleotide (the start for + strand, the end for the - strand, i.e. counting from the end of the gene) """
+  exons=sorted( zip( table.exon_starts[ table.exon_offsets[i]:table.exon_offsets[i+1] ].tolist(), table.exon_ends[ table.exon_offsets[i]:table.exon_offsets[i+1] ].tolist() ) )
+  if table.strand_names[ table.strand[i] ]=='-':  exons.reverse()
+  out=[];  cds_position=0
+  for start, end in exons:
+    out.append( (start, end, cds_position%3) );  cds_position+=end-start+1
+  if table.strand_names[ table.strand[i] ]=='-':  out.reverse()
+  return out
+
+def _genes_overlap(frames_i, frames_j, minus_strand, phase):
+  """ Returns True if some exons of two genes overlap (in the same frame, if phase is True), given their exons as returned by _gene_frames.
+  Genes must be on the same chromosome and strand (minus_strand: True for - strand) """
+  for start_i, end_i, frame_i in frames_i:
+    for start_j, end_j, frame_j in frames_j:
+      if start_i>end_j or start_j>end_i: continue
+      if not phase: return True
+      if not minus_strand:   position=max(start_i, start_j);  same_frame= (frame_i+position-start_i)%3 == (frame_j+position-start_j)%3
+      else:                  position=min(end_i, end_j);      same_frame= (frame_i+end_i-position)%3 == (frame_j+end_j-position)%3
+      if same_frame: return True
+  return False
+
+def _resolve_overlap_group(group_index):
+  """ Sweep line over a group of genes of _overlap_args (one chromosome and strand, sorted by start): each gene is compared only with those still active
+  (ending at or after its start), and overlapping ones are joined (union-find) in clusters. Returns (group_index, kept) where kept[k] is the position
+  (in the group) of the gene kept for the cluster of the k-th gene: the one with highest score, the first in order for ties """
+  table, order, groups, scores, phase = _overlap_args
+  group_start, group_end = groups[group_index]
+  genes=order[group_start:group_end].tolist();  starts=table.start[genes].tolist();  ends=table.end[genes].tolist();  group_scores=scores[genes].tolist()
+  parent=range(len(genes))
+  def find(k):
+    while parent[k]!=k:   parent[k]=parent[parent[k]];  k=parent[k]
+    return k
+  minus_strand= bool(genes) and table.strand_names[ table.strand[genes[0]] ]=='-'
+  active=[]    # heap of (end, position)
+  frames={}    # position -> exons with frames (see _gene_frames), for active genes only
+  for k, i in enumerate(genes):
+    while active and active[0][0]<starts[k]:  del frames[ heapq.heappop(active)[1] ]
+    frames[k]=_gene_frames(table, i)
+    for other_end, other_k in active:
+      root_k, root_other = find(k), find(other_k)
+      if root_k!=root_other and _genes_overlap(frames[k], frames[other_k], minus_strand, phase):   parent[max(root_k, root_other)]=min(root_k, root_other)
+    heapq.heappush(active, (ends[k], k))
+  root2best={}
+  for k in xrange(len(genes)):
+    root=find(k)
+    if not root in root2best or group_scores[k]>group_scores[ root2best[root] ]:  root2best[root]=k
+  return group_index, [ root2best[find(k)] for k in xrange(len(genes)) ]
+
+def resolve_overlaps(table, scores, phase=False, n_cpus=1):
+  """ Finds clusters of overlapping genes in a gene_table (same chromosome and strand; with phase, exons must overlap in frame), and keeps only the best one
+  of each cluster according to scores (array with a value per gene). Chromosome and strand groups are resolved independently (see _resolve_overlap_group),
+  in a pool of n_cpus processes. Returns an array with, for each gene, the index of the gene kept instead of it (itself, if kept) """
+  global _overlap_args
+  order=numpy.lexsort( (table.start, table.strand, table.chromosome) )     # stable: ties keep the order of the table
+  key_changes=numpy.flatnonzero( (table.chromosome[order][1:]!=table.chromosome[order][:-1]) | (table.strand[order][1:]!=table.strand[order][:-1]) )+1
+  bounds=[0]+key_changes.tolist()+[len(table)]
+  groups=[ (start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end>start ]
+  _overlap_args=(table, order, groups, scores, phase)
+  by_size=sorted( range(len(groups)), key=lambda group_index:groups[group_index][1]-groups[group_index][0], reverse=True )   #largest first, for balance
+  if n_cpus>1 and len(groups)>1:
+    pool=multiprocessing.Pool( min(n_cpus, len(groups)) )
+    results=list( pool.imap_unordered(_resolve_overlap_group, by_size) )
+    pool.close();  pool.join()
+  else: results=map(_resolve_overlap_group, by_size)
+  kept_instead=numpy.arange(len(table))
+  for group_index, kept in results:
+    group_genes=order[ groups[group_index][0]:groups[group_index][1] ]
+    kept_instead[group_genes]=group_genes[kept]
+  _overlap_args=None
+  return kept_instead
+
+class color_allocator(object):
+  """ Assigns color combinations to families without building the list of all combinations. With color scheme s, combination k (0 <= k < n**(s+1)) of
+  the n individual colors has as fill color the digit 0 of k in base n, as outline the digit 1, and so on: the order of the lists built before (so, the
+  same colors). Combinations in colors_already_taken (keys like "fill,outline,box_bkg,box_outline", with "None") are skipped, as those with the first
+  three colors equal (schemes 2 and 3). Colors are assigned in this order, or from a random combination (randomize), or from one chosen by a stable hash
+  of the family id (hashed: a family gets the same colors in all runs with the same -c and -cr, unless already assigned); in the last two cases,
+  used combinations are skipped looking at the next ones """
+  def __init__(self, individual_colors, color_scheme, colors_already_taken, randomize=False, hashed=False):
+    self.individual_colors=individual_colors;  self.size=color_scheme+1;  self.colors_already_taken=colors_already_taken
+    self.randomize=randomize;  self.hashed=hashed
+    self.n_combinations=len(individual_colors)**self.size
+    self.used=set();  self.next_combination=0
+
+  def combination(self, k):
+    """ Returns the colors [fill, outline, box_bkg, box_outline] of combination k, or None if it cannot be used """
+    n=len(self.individual_colors);  the_colors=[]
+    for i in range(self.size):  the_colors.append( self.individual_colors[k % n] );  k//=n
+    if self.size>=3 and the_colors[0]==the_colors[1]==the_colors[2]: return None
+    the_colors+=[None]*(4-self.size)
+    if join( map(str, the_colors), ',') in self.colors_already_taken:  return None
+    return the_colors
+
+  def new_color(self, family):
+    """ Returns the colors for a family not seen before; raises IndexError if no combination is left """
+    if not self.randomize and not self.hashed:
+      while self.next_combination<self.n_combinations:
+        the_colors=self.combination(self.next_combination);  self.next_combination+=1
+        if not the_colors is None: return the_colors
+      raise IndexError
+    if not self.n_combinations: raise IndexError
+    if self.hashed:  start=int( hashlib.md5(family).hexdigest(), 16 ) % self.n_combinations
+    else:            start=random.randrange(self.n_combinations)
+    for k in chain( xrange(start, self.n_combinations), xrange(start) ):
+      if not k in self.used:
+        self.used.add(k);  the_colors=self.combination(k)
+        if not the_colors is None: return the_colors
+    raise IndexError
+
 class notracebackException(Exception):
   """ when raising one of these, the python error message will be much less verbose than the standard traceback """
 
@@ -155,7 +558,7 @@ def main(args={}):
 
   #######
   ### processing options controlling colors
-  colors_already_taken={}  # useful for later, when we compute available_colors
+  colors_already_taken={}  # useful for later, when we choose colors for families
   color_genes_of_interest=[None, None, None, None]
   if opt['ci']: 
     for index, color in enumerate( opt['ci'].split(',') ):  
@@ -187,48 +590,57 @@ def main(args={}):
   color_scheme=opt['cr'];       
   if not color_scheme in [0, 1, 2, 3]: raise notracebackException, "ERROR invalid color scheme provided with option -cr ! see -help"
   individual_colors=[line.strip() for line in open(color_file) if line.strip()]; 
-  if     color_scheme==0:  available_colors = [[a,None,None,None] for a in individual_colors if not a+',None,None,None' in colors_already_taken]
-  elif   color_scheme==1:  available_colors = [[b,   a,None,None] for a in individual_colors for b in individual_colors if not b+','+a+',None,None' in colors_already_taken]
-  elif   color_scheme==2:  available_colors = [[c,   b,   a,None] for a in individual_colors for b in individual_colors for c in individual_colors if not (a==b==c) and not c+','+b+','+a+',None' in colors_already_taken]
-  elif   color_scheme==3:  available_colors = [[d,   c,   b,   a] for a in individual_colors for b in individual_colors for c in individual_colors for d in individual_colors if not (b==c==d) and not d+','+c+','+b+','+a in colors_already_taken]
-  #write('available colors: {0}'.format(len(available_colors)), 1)
-
-  if opt['rc']:   random.shuffle(available_colors)
+  family_colors=color_allocator(individual_colors, color_scheme, colors_already_taken, randomize=opt['rc'], hashed=opt['hc'])   # combinations are built on demand
 
   ######
   ## loading gff input files    # genes of interest
   input_get_id_function=None; 
-  if opt['if']: input_get_id_function=eval('lambda x:'+opt['if'])
+  if opt['if']: input_get_id_function=gff_id_function(opt['if'])
   write('Loading genes of interest from {0:<30} ... '.format(input_gff_file)) 
-  genes_of_interest=load_all_genes(input_gff_file, tag='*', get_id=input_get_id_function, is_sorted=True)
+  if input_get_id_function:   genes_of_interest=load_gff_genes(input_gff_file, tag='*', get_id=input_get_id_function).gene_objects()
+  else:                       genes_of_interest=load_all_genes(input_gff_file, tag='*', get_id=input_get_id_function, is_sorted=True)
   for g_index, g in enumerate(genes_of_interest): g.is_of_interest=g_index+1   ### keeping this as a number so later we can sort output in the same order as input
   write('done. Genes: {0}'.format(len(genes_of_interest)), 1)
+  max_distance = opt['l']
                                 # gene in global annotation
   annotation_get_id_function=None; 
-  if opt['af']: annotation_get_id_function=eval('lambda x:'+opt['af'])
+  if opt['af']: annotation_get_id_function=gff_id_function(opt['af'])
   annotation_tag=opt['at']
-  write('Loading annotated genes from   {0:<30} ... '.format(annotation_gff_file)) 
-  annotated_genes=load_all_genes(annotation_gff_file, tag=annotation_tag, get_id=annotation_get_id_function)
-  for a in annotated_genes: a.is_of_interest=False
+  if not annotation_get_id_function:
+    write('Loading annotated genes from   {0:<30} ... '.format(annotation_gff_file)) 
+    annotated_genes=gene_table_from_genes( load_all_genes(annotation_gff_file, tag=annotation_tag, get_id=annotation_get_id_function) )
+  else:   ## by default, loading only the genes in the regions that can be displayed: those around genes of interest (with -n, their whole chromosomes)
+    regions=None
+    if not opt['fa']:  regions=target_regions(genes_of_interest, None if opt['n'] else max_distance)
+    write('Loading annotated genes from   {0:<30} ... '.format(annotation_gff_file)) 
+    annotated_genes=load_gff_genes(annotation_gff_file, tag=annotation_tag, get_id=annotation_get_id_function, regions=regions, n_cpus=opt['cpu'])
+    if regions: write('in {0} regions around genes of interest ... '.format( sum( len(starts) if not starts is None else 1 for starts, ends in regions.values() ) ))
   write('done. Genes: {0}'.format(len(annotated_genes)), 1)
+  ## all genes are kept in a columnar table (genes of interest first); gene objects are built only for those displayed
+  all_genes=concatenate_gene_tables( [gene_table_from_genes(genes_of_interest, interest=True), annotated_genes] )
+  del annotated_genes
   ######
 
   ## load homology file
-  geneid2family={}; families_dict={}
-  write('Loading homology families from {0:<30} ... '.format(homology_file)) 
-  for line in open(homology_file):
-    splt=line.strip().split('\t')
-    if splt:  geneid, family = splt; geneid2family[geneid]=family; families_dict[family]=0
-  write('done.', 1)
-
-  ## print some stats
-  for g in annotated_genes: 
-    if g.id in geneid2family:  families_dict[geneid2family[g.id]]+=1
-  n_fam_represented=0; n_genes_with_family=0
-  for fam in families_dict: 
-    if families_dict[fam]>0: n_fam_represented+=1; n_genes_with_family+=families_dict[fam]
-  write('N of families: {0} ; {1} families have 1 or more gene(s) found in annotation.\nA total of {2} genes have a family assigned.\n'.format(len(families_dict),n_fam_represented, n_genes_with_family ), 1)
-  del families_dict;  #saving memory (almost a joke)
+  if is_family_index(homology_file):
+    write('Opening homology families index {0:<30} ... '.format(homology_file)) 
+    geneid2family=family_index(homology_file)     # dictionary-like, genes are looked up on demand
+    write('done.', 1)
+    write('N of families: {0} ; {1} genes have a family assigned (binary index: per-annotation stats are skipped).\n'.format(geneid2family.n_families, len(geneid2family)), 1)
+  else:
+    geneid2family={}; families_dict={}
+    write('Loading homology families from {0:<30} ... '.format(homology_file)) 
+    for line in open(homology_file):
+      splt=line.strip().split('\t')
+      if splt:  geneid, family = splt; geneid2family[geneid]=family; families_dict[family]=0
+    write('done.', 1)
+
+    ## print some stats
+    all_genes.set_families(geneid2family)
+    annotated_families=all_genes.family[ (all_genes.interest==0) & (all_genes.family>=0) ]
+    n_fam_represented=len( numpy.unique(annotated_families) ); n_genes_with_family=len(annotated_families)
+    write('N of families: {0} ; {1} families have 1 or more gene(s) found in the annotation loaded.\nA total of {2} genes have a family assigned.\n'.format(len(families_dict),n_fam_represented, n_genes_with_family ), 1)
+    del families_dict;  #saving memory (almost a joke)
   family2genes_displayed={}      ### later we'll modify geneid2family to avoid displaying useless families
 
   ## families or genes in the annotation to be ignored
@@ -241,99 +653,87 @@ def main(args={}):
 
   ##############################  start doing things!
   ## finding overlaps
-  def scoring_function_for_overlaps(g):    return int (g.is_of_interest)* 10000000 + g.length()
-  removed_overlapping_genes=[]
-  non_red_genes = remove_overlapping_gene_clusters( genes_of_interest + annotated_genes,  scoring=scoring_function_for_overlaps, phase=True, strand=True, out_removed_genes=removed_overlapping_genes, remember_overlaps=True )
+  scores_for_overlaps= all_genes.interest.astype(numpy.int64)*10000000 + all_genes.length      # genes of interest first (by rank), then the longest
+  kept_instead = resolve_overlaps( all_genes, scores_for_overlaps, phase=True, n_cpus=opt['cpu'] )
   ### getting all discarded -> kept  relationship, and back
-  for g in removed_overlapping_genes: 
-    if not hasattr( g.overlapping, 'discarded'): g.overlapping.discarded=[]
-    g.overlapping.discarded.append( g )
-  for g in genes_of_interest: 
-    if hasattr( g, 'discarded'): #len(g.discarded)>1: 
-      for d in g.discarded:   write(' Gene: {0:^25} removed overlapping gene: {1}'.format(g.id, d.id), 1)
-
-  non_red_genes.sort(  cmp=order_genes_for_chr_pos  )   #sorting again... not optimized but easy
+  discarded=defaultdict(list)
+  for index in numpy.flatnonzero( kept_instead!=numpy.arange(len(all_genes)) ):   discarded[ kept_instead[index] ].append( index )
+  for g_index, g in enumerate(genes_of_interest):     # genes of interest are the first in all_genes
+    for d in discarded.get(g_index, []):   write(' Gene: {0:^25} removed overlapping gene: {1}'.format(g.id, all_genes.ids[d]), 1)
+  non_red_genes= all_genes.sorted_indexes( numpy.flatnonzero( kept_instead==numpy.arange(len(all_genes)) ) )   # indexes of genes kept, sorted by chromosome and position
+
   ######
 
   ##############################
-  ## building gene clusters to be displayed
-  gene_clusters=[]   # list of lists of genes; populating this while parsing the sorted list of genes and looking for the genes of interest.
-  max_distance = opt['l']
-  index=0
-  while index < len(non_red_genes):
-    if non_red_genes[index].is_of_interest:
-      g=non_red_genes[index]
-      verbose('*** Cluster of {0}'.format(g.id), 1)
-      gc=gene_cluster();  gc.append(g); gc.link_to_gene(g)
-
-      ## parsing back CAREFUL ASSUMING THERE ARE NO NESTED STRUCTURES WITH EXONS
-      other_index=index-1
-      while other_index >= 0 and non_red_genes[other_index].chromosome == g.chromosome and  \
-        (  (not opt['n'] and abs( g.boundaries()[0] - non_red_genes[other_index].boundaries()[1] ) <= max_distance )  or \
-           (    opt['n'] and len(gc)-1 <= opt['n']    )    ):
-        if not  non_red_genes[other_index].id in fams_to_ignore and not \
-           (non_red_genes[other_index].id in geneid2family and geneid2family[non_red_genes[other_index].id] in fams_to_ignore):
-          gc.insert(0, non_red_genes[other_index])
-        other_index-=1
-      n_genes_added_back=len(gc)-1
-
-      #parsing forward                                                                                               
-      other_index=index+1
-      while other_index < len(non_red_genes) and non_red_genes[other_index].chromosome == g.chromosome and \
-        (   (not opt['n'] and abs( non_red_genes[other_index].boundaries()[0] - g.boundaries()[1] ) <= max_distance )  or \
-            (    opt['n'] and len(gc)-1-n_genes_added_back <= opt['n']    )    ):
-        if not  non_red_genes[other_index].id in fams_to_ignore and not \
-           (non_red_genes[other_index].id in geneid2family and geneid2family[non_red_genes[other_index].id] in fams_to_ignore):            
-          gc.append(non_red_genes[other_index])
-        other_index+=1
-
-      for i in gc:       verbose( i.gff(), 1)
-      gene_clusters.append(gc) 
-
-    index+=1
+  ## building gene windows to be displayed: each is a list of positions in non_red_genes (ascending); gene objects are built only once windows are merged
+  windows=[]   # list of (position of the gene of interest, positions of the genes displayed around it)
+  def is_displayed(position):
+    gid=all_genes.ids[ non_red_genes[position] ]
+    return not gid in fams_to_ignore and not (gid in geneid2family and geneid2family[gid] in fams_to_ignore)
+  def is_of_interest(position):  return all_genes.interest[ non_red_genes[position] ]>0
+  window_index=gene_interval_index(all_genes, non_red_genes)
+  for index in numpy.flatnonzero( all_genes.interest[non_red_genes]>0 ).tolist():
+    verbose('*** Cluster of {0}'.format(all_genes.ids[ non_red_genes[index] ]), 1)
+    if not opt['n']:     ## genes overlapping the region from max_distance before g to max_distance after it
+      positions=[position for position in window_index.distance_window(index, max_distance) if position==index or is_displayed(position)]
+    else:                ## genes sorted before and after g, skipping those ignored
+      positions=list( islice( ifilter(is_displayed, window_index.positions_before(index)), opt['n']+1 ) )[::-1] + [index] + \
+                list( islice( ifilter(is_displayed, window_index.positions_after(index)), opt['n']+1 ) )
+    if opt['v']:
+      for position in positions:     verbose( all_genes.gene_object( non_red_genes[position] ).gff(), 1)
+    windows.append( (index, positions) )
 
   ## populating family2genes_displayed to compress family output
-  for gc in gene_clusters:
-    for g in gc: 
-      if g.id in geneid2family: 
-        fam=geneid2family[g.id]
+  for index, positions in windows:
+    for position in positions:
+      gid=all_genes.ids[ non_red_genes[position] ]
+      if gid in geneid2family: 
+        fam=geneid2family[gid]
         if not fam in family2genes_displayed: family2genes_displayed[fam]={}
-        family2genes_displayed[fam][g.id]=True
+        family2genes_displayed[fam][gid]=True
 
   if opt['rs']:
-    ## removing singlets
+    ## removing singlets; all are found before removing any, so that a gene displayed in more windows is removed from all of them
+    def is_singlet(position):
+      gid=all_genes.ids[ non_red_genes[position] ]
+      return not is_of_interest(position) and ( not gid in geneid2family or len(family2genes_displayed[ geneid2family[gid] ])==1 )
+    singlets=set( position for index, positions in windows for position in positions if is_singlet(position) )
     n_singlets_removed=0
-    for gc in gene_clusters:
-      len_gc=len(gc)
-      for i in range(len_gc): 
-        g_index= len_gc-i-1  #parsing in reverse order to make .pop() work
-        g= gc[g_index]
-        if  not g.is_of_interest and ( not g.id in geneid2family or len(family2genes_displayed[ geneid2family[g.id] ])==1 ):  
-          gc.pop(g_index); n_singlets_removed+=1;  del family2genes_displayed[ geneid2family[g.id] ]
+    for index, positions in windows:
+      len_positions=len(positions)
+      positions[:]=[position for position in positions if not position in singlets];   n_singlets_removed+=len_positions-len(positions)
+    for position in singlets:
+      gid=all_genes.ids[ non_red_genes[position] ]
+      if gid in geneid2family:  del family2genes_displayed[ geneid2family[gid] ]
     if n_singlets_removed: write('Option -rs: {0} singlets were removed! '.format(n_singlets_removed), 1)
 
-  #### merging clusters that share at least one gene
-  if not opt['dm']:
-    ## since they are sorted, a cluster can share genes only with its previous or next cluster. Also, if we scan forward, we just check if the last gene in a cluster is contained in the next one
-    gc_index=0
-    while gc_index+1<len(gene_clusters):   #+1 since, if it's the last one, it's not interesting
-      current_gc=gene_clusters[gc_index];    next_gc=gene_clusters[gc_index+1]
-      merged=False
-      if current_gc[0].chromosome == next_gc[0].chromosome: # and current_gc[-1] in next_gc:     --> in practice this is what we check. but let's do it more efficiently
-        try:     
-          index_pos= next_gc.index(current_gc[-1])  # this cause an exception if not there
-          merged=True             #### Yes we're officially merging
-          write('Merging the surrounds of {0:>25} and {1:<25}'.format(current_gc.ref_gene.id,  next_gc.ref_gene.id), 1)
-          for gc in next_gc[index_pos+1:]:   current_gc.append( gc )
-          possible_ref_genes=[]
-          for g_index, g in enumerate(current_gc):
-            if g.is_of_interest: g.g_index=g_index; possible_ref_genes.append(g)
-          middle_point = (len(current_gc)-1)/2.0
-          best_ref_gene = min (possible_ref_genes, key= lambda x:abs(x.g_index-middle_point))
-          current_gc.link_to_gene(best_ref_gene)
-          gene_clusters.pop(gc_index+1)   #removing next_gc
-        except ValueError: pass
-      if not merged:    gc_index+=1
+  #### merging windows that share at least one gene
+  ## windows are sorted, so a window can share genes only with its previous or next one. Scanning forward, we look for the last gene of the current (merged)
+  ## window in the next one, with bisect since positions are ascending; if found, only the genes after it are added. The reference gene is the gene of
+  ## interest closest to the middle of the merged window (the first one on ties), found by bisect among the indexes of genes of interest in the window
+  merged_windows=[]   # list of [position of reference gene, positions, indexes in positions of genes of interest]
+  for index, positions in windows:
+    if merged_windows and not opt['dm']:
+      current=merged_windows[-1];  current_positions=current[1];  interest_indexes=current[2]
+      shared_index=bisect_left(positions, current_positions[-1])
+      if shared_index<len(positions) and positions[shared_index]==current_positions[-1]:      #### Yes we're officially merging
+        write('Merging the surrounds of {0:>25} and {1:<25}'.format(all_genes.ids[ non_red_genes[current[0]] ],  all_genes.ids[ non_red_genes[index] ]), 1)
+        for position in positions[shared_index+1:]:
+          if is_of_interest(position):  interest_indexes.append( len(current_positions) )
+          current_positions.append(position)
+        middle_point = (len(current_positions)-1)/2.0
+        closest=bisect_left(interest_indexes, middle_point)
+        if closest==len(interest_indexes) or ( closest and middle_point-interest_indexes[closest-1] <= interest_indexes[closest]-middle_point ):  closest-=1
+        current[0]=current_positions[ interest_indexes[closest] ]
+        continue
+    merged_windows.append( [index, positions, [i for i, position in enumerate(positions) if is_of_interest(position)]] )
+
+  ## building the gene clusters to be displayed, as lists of gene objects
+  gene_clusters=[]
+  for ref_position, positions, interest_indexes in merged_windows:
+    gc=gene_cluster( all_genes.gene_object( non_red_genes[position] ) for position in positions )
+    gc.link_to_gene( all_genes.gene_object( non_red_genes[ref_position] ) )
+    gene_clusters.append(gc)
        
   geneid2color={}
   ### parsing each single gene in each cluster. deciding COLORS
@@ -347,7 +747,7 @@ def main(args={}):
           geneid2color[g.id]= color_singlets   ## singlet being only representative for its family
         else:   
           if not fam in fam2color:     # not yet assigned to this family
-            try:                fam2color[fam]=available_colors.pop(0)
+            try:                fam2color[fam]=family_colors.new_color(fam)
             except IndexError:  raise notracebackException, "ERROR not enough colors are available to display this! Increase the number of colors in the -c file or change the color scheme with -cr"
           geneid2color[g.id]= fam2color[fam]
       else:    geneid2color[g.id]=color_singlets     ## singlet that does not belong to any family